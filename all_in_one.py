@@ -0,0 +1,81 @@
+import asyncio
+import signal
+
+from storage import db
+from instrumentation import get_output_log, setup_logging, start_metrics_server, stop_logging
+from profiling import install_profiling_handler
+import bot as bot_service
+import notifier
+import spider
+
+# Spider, notifier, retrospective search agents, archiver and bot polling as
+# tasks of one loop. They share the storage client, the Telegram session and
+# the metrics registry, so one endpoint serves the metrics of every service.
+METRICS_PORT = 9100
+
+output_log = get_output_log("all_in_one")
+
+
+async def start():
+    output_log("Waiting for storage")
+    await db.wait_ready()
+    await start_metrics_server(METRICS_PORT)
+    # Notifier creates the indexes before the other services use them
+    await notifier.init_db()
+    asyncio.create_task(spider.start_spider())
+    asyncio.create_task(notifier.start_retrospective_search_agents())
+    asyncio.create_task(notifier.start_notifier())
+    asyncio.create_task(notifier.start_archiver())
+    asyncio.create_task(bot_service.start_bot())
+
+
+async def shutdown(loop, signal=None):
+    if signal:
+        output_log(f"Received exit signal {signal.name}")
+    await notifier.wait_admin_notifications()
+    await bot_service.stop_webhook()
+    tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+    [task.cancel() for task in tasks]
+    output_log(f"Cancelling {len(tasks)} tasks")
+    await asyncio.gather(*tasks, return_exceptions=True)
+    await spider.close()
+    await bot_service.close()
+    # Closes the Telegram sessions shared with the bot
+    await notifier.close()
+    output_log(f"Closing database session")
+    db.close()
+    output_log("Done.")
+    loop.stop()
+
+
+def handle_uncaught_exception(loop, context):
+    msg = context.get("exception", context["message"])
+    output_log(f"Caught exception: {msg}", "ERROR")
+    output_log("Notifying admins")
+    notify_flag = True
+    for task in asyncio.all_tasks():
+        if task.get_name() == notifier.NOTIFY_ADMINS_TASK_NAME:
+            notify_flag = False
+    if notify_flag:
+        asyncio.create_task(
+            notifier.notify_admins(f"ALL-IN-ONE Caught exception: {msg}"), name=notifier.NOTIFY_ADMINS_TASK_NAME
+        )
+    output_log("Shutting down")
+    asyncio.create_task(shutdown(loop))
+
+
+if __name__ == "__main__":
+    setup_logging()
+    loop = db.loop
+    signals = (signal.SIGHUP, signal.SIGTERM, signal.SIGINT)
+    for s in signals:
+        loop.add_signal_handler(s, lambda s=s: asyncio.create_task(shutdown(loop, signal=s)))
+    install_profiling_handler(loop, "all_in_one")
+    loop.set_exception_handler(handle_uncaught_exception)
+    try:
+        loop.create_task(start())
+        loop.run_forever()
+    finally:
+        output_log("Successfully shutdown all-in-one")
+        loop.close()
+        stop_logging()
@@ -0,0 +1,39 @@
+import json
+import zlib
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List
+
+# Archived apps of one author are kept in a document per time bucket as a
+# zlib compressed JSON list of rows. Buckets are counted from a Monday, so
+# 7 day buckets are calendar weeks.
+ARCHIVE_FIELDS = ("name", "author", "countries", "link")
+BUCKET_EPOCH = datetime(1970, 1, 5)
+COMPRESSION_LEVEL = 6
+
+
+def get_bucket(created: datetime, bucket_days: int) -> datetime:
+    width = timedelta(days=bucket_days)
+    return BUCKET_EPOCH + (created - BUCKET_EPOCH) // width * width
+
+
+def pack_apps(apps: Iterable[Dict]) -> bytes:
+    rows = [[app[field] for field in ARCHIVE_FIELDS] + [app["created"].timestamp()] for app in apps]
+    return zlib.compress(json.dumps(rows, separators=(",", ":")).encode(), COMPRESSION_LEVEL)
+
+
+def unpack_apps(data: bytes) -> List[Dict]:
+    return [
+        dict(zip(ARCHIVE_FIELDS, row), created=datetime.fromtimestamp(row[-1]))
+        for row in json.loads(zlib.decompress(data))
+    ]
+
+
+def merge_apps(archived: List[Dict], apps: Iterable[Dict]) -> List[Dict]:
+    # Archiving an app again replaces it, newest first like the searches
+    merged = {app["link"]: app for app in archived}
+    merged.update((app["link"], {field: app[field] for field in ARCHIVE_FIELDS + ("created",)}) for app in apps)
+    return sorted(merged.values(), key=lambda app: app["created"], reverse=True)
+
+
+def filter_apps(apps: List[Dict], since: datetime, until: datetime) -> List[Dict]:
+    return [app for app in apps if since <= app["created"] < until]
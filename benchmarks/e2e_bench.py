@@ -0,0 +1,273 @@
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import logging
+import os
+import random
+import re
+import socket
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+BENCH_DIR = Path(__file__).resolve().parent
+sys.path[:0] = [str(REPO_DIR), str(BENCH_DIR)]
+
+API_TOKEN = "123456:BENCH-TOKEN-abcdefghijklmnopqrstuvwxyz"
+LINK_RE = re.compile(r"https://apps\.apple\.com/\S+")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="End-to-end spider/notifier/bot benchmark")
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--developers", type=int, default=100)
+    parser.add_argument("--subscriptions", type=int, default=3, help="developers per user")
+    parser.add_argument("--apps", type=int, default=50, help="new apps per cycle")
+    parser.add_argument("--cycles", type=int, default=5)
+    parser.add_argument("--searches", type=int, default=100)
+    parser.add_argument("--pages-deep", type=int, default=10)
+    parser.add_argument("--apps-per-page", type=int, default=50)
+    parser.add_argument("--incremental", action="store_true", help="incremental crawl after the first cycle")
+    parser.add_argument("--latency", type=float, default=0.0, help="fake Telegram latency, seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fake Telegram 429 rate")
+    parser.add_argument("--webhook", action="store_true", help="send bot updates through the webhook server")
+    parser.add_argument("--no-rate-limit", action="store_true", help="disable the send scheduler limits")
+    parser.add_argument("--verbose", action="store_true", help="show service logs")
+    return parser.parse_args()
+
+
+def prepare_secrets():
+    # Services read secrets relative to the working directory at import
+    workdir = tempfile.mkdtemp(prefix="storeglide-bench-")
+    secrets_dir = Path(workdir) / "secrets"
+    secrets_dir.mkdir()
+    proxy = {"proxy_host": "127.0.0.1", "proxy_port": 1080, "proxy_user": "bench", "proxy_pass": "bench"}
+    (secrets_dir / "http_proxy.json").write_text(json.dumps(proxy))
+    (secrets_dir / "credentials.json").write_text(json.dumps(dict(proxy, api_token=API_TOKEN)))
+    (secrets_dir / "admins.json").write_text(json.dumps({"cids": []}))
+    os.chdir(workdir)
+
+
+def get_free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def start_server(app) -> (object, int):
+    from aiohttp import web
+
+    port = get_free_port()
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    return runner, port
+
+
+def percentile(values, q: float) -> float:
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+def make_update(update_id: int, cid: int, text: str) -> dict:
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": cid, "type": "private"},
+            "from": {"id": cid, "is_bot": False, "first_name": "Bench"},
+            "text": text,
+        },
+    }
+
+
+async def run(args, services, quiet):
+    import aiogram.bot.api
+    from aiogram import Bot, types
+    from aiohttp import ClientSession
+    from fake_storeglide import FakeStoreglide
+    from fake_telegram import FakeTelegram
+    from proxies import ProxyPool
+    from sender import TokenBucket
+    import telegram as telegram_service
+
+    spider, notifier, bot_service = services
+    developers = [f"Bench Developer {i}" for i in range(args.developers)]
+    storeglide = FakeStoreglide(developers, args.apps_per_page, args.pages_deep)
+    # Bot handlers answer directly without the send scheduler, 429s are only
+    # injected for the notification cycles
+    telegram = FakeTelegram(args.latency)
+    storeglide_runner, storeglide_port = await start_server(storeglide.make_app())
+    telegram_runner, telegram_port = await start_server(telegram.make_app())
+
+    aiogram.bot.api.API_URL = f"http://127.0.0.1:{telegram_port}/bot{{token}}/{{method}}"
+    spider.STOREGLIDE_URL = f"http://127.0.0.1:{storeglide_port}/"
+    bench_bot = Bot(token=API_TOKEN)
+    Bot.set_current(bench_bot)
+    bot_service.dp.bot = bench_bot
+    notifier.scheduler.bots = ProxyPool("telegram", [None], lambda url: bench_bot, telegram_service.is_proxy_failure)
+    if args.no_rate_limit:
+        notifier.scheduler.global_bucket = TokenBucket(1e9, 1e9)
+        notifier.scheduler.chat_rate = 1e9
+
+    parsed_apps = 0
+    parse_page_for_apps = spider.parse_page_for_apps
+
+    async def counting_parse_page_for_apps(page):
+        nonlocal parsed_apps
+        apps = await parse_page_for_apps(page)
+        parsed_apps += len(apps)
+        return apps
+
+    spider.parse_page_for_apps = counting_parse_page_for_apps
+
+    report = dict()
+    with quiet():
+        await notifier.init_db()
+
+    if args.webhook:
+        bot_service.WEBHOOK_HOST = "127.0.0.1"
+        bot_service.WEBHOOK_PORT = get_free_port()
+        bot_service.WEBHOOK_URL = f"http://127.0.0.1:{bot_service.WEBHOOK_PORT}"
+        with quiet():
+            await bot_service.start_webhook()
+    webhook_session = ClientSession()
+
+    async def post_updates(updates):
+        # One chat posts in order, chats post concurrently
+        by_chat = dict()
+        for update in updates:
+            by_chat.setdefault(update["message"]["chat"]["id"], []).append(update)
+
+        async def post_chat_updates(chat_updates):
+            for update in chat_updates:
+                async with webhook_session.post(bot_service.WEBHOOK_URL + bot_service.WEBHOOK_PATH, json=update) as response:
+                    response.raise_for_status()
+
+        await asyncio.gather(*(post_chat_updates(chat_updates) for chat_updates in by_chat.values()))
+        await bot_service.update_workers.ready.join()
+
+    async def process_updates(updates):
+        if args.webhook:
+            await post_updates(updates)
+            return
+        for update in updates:
+            await bot_service.dp.process_update(types.Update(**update))
+
+    # Users register and subscribe through the bot handlers
+    update_id = 0
+    updates = list()
+    for cid in range(1, args.users + 1):
+        commands = ["/register"] + [f"/add {dev}" for dev in random.sample(developers, args.subscriptions)]
+        for text in commands:
+            update_id += 1
+            updates.append(make_update(update_id, cid, text))
+    started = time.monotonic()
+    with quiet():
+        await process_updates(updates)
+    commands_time = time.monotonic() - started
+    report["bot commands/s"] = update_id / commands_time
+    # Drop bot answers and retrospective search prompts from the delivery stats
+    telegram.sent.clear()
+    telegram.error_rate = args.error_rate
+
+    spider_time = notify_time = 0.0
+    notifications = 0
+    # Direct connections, one session
+    spider_pool = ProxyPool("storeglide", [None], lambda url: ClientSession(), spider.is_proxy_failure)
+    try:
+        for cycle in range(args.cycles):
+            storeglide.publish(args.apps)
+            # Pages past the published apps would be empty
+            spider.STOREGLIDE_PAGES_DEEP = spider.INCREMENTAL_PAGES_DEEP = storeglide.filled_pages
+            started = time.monotonic()
+            with quiet():
+                await spider.run_spider_cycle(spider_pool, full_sweep=not args.incremental or cycle == 0)
+            spider_time += time.monotonic() - started
+
+            started = time.monotonic()
+            sent_before = len(telegram.sent)
+            with quiet():
+                await notifier.notify_users()
+            notify_time += time.monotonic() - started
+            notifications += sum(len(LINK_RE.findall(text)) for _, _, text in telegram.sent[sent_before:])
+    finally:
+        await spider_pool.close()
+
+    latencies = [
+        sent_at - storeglide.published[link]
+        for sent_at, _, text in telegram.sent
+        for link in LINK_RE.findall(text)
+        if link in storeglide.published
+    ]
+    messages = len(telegram.sent)
+
+    telegram.error_rate = 0.0
+    updates = list()
+    for _ in range(args.searches):
+        update_id += 1
+        text = f"/search {random.choice(developers)}"
+        updates.append(make_update(update_id, random.randint(1, args.users), text))
+    started = time.monotonic()
+    with quiet():
+        await process_updates(updates)
+    search_time = time.monotonic() - started
+
+    report.update({
+        "pages fetched": storeglide.requests,
+        "pages not modified": storeglide.not_modified,
+        "pages/s": storeglide.requests / spider_time,
+        "apps parsed/s": parsed_apps / spider_time,
+        "notification messages": messages,
+        "notifications/s": notifications / notify_time if notify_time else 0.0,
+        "messages/s": messages / notify_time if notify_time else 0.0,
+        "telegram 429s": telegram.rate_limited,
+        "latency p50, s": percentile(latencies, 0.5),
+        "latency p99, s": percentile(latencies, 0.99),
+        "searches/s": args.searches / search_time,
+    })
+
+    with quiet():
+        await bot_service.stop_webhook()
+    await webhook_session.close()
+    await bench_bot.close()
+    await storeglide_runner.cleanup()
+    await telegram_runner.cleanup()
+    return report
+
+
+def main():
+    args = parse_args()
+    random.seed(42)
+    prepare_secrets()
+    os.environ.setdefault("STORAGE_BACKEND", "memory")
+
+    import spider
+    import notifier
+    import bot as bot_service
+
+    logging.getLogger().setLevel(logging.INFO if args.verbose else logging.WARNING)
+
+    def quiet():
+        if args.verbose:
+            return contextlib.nullcontext()
+        return contextlib.redirect_stdout(io.StringIO())
+
+    report = notifier.db.loop.run_until_complete(
+        run(args, (spider, notifier, bot_service), quiet)
+    )
+    print(f"storage: {os.environ['STORAGE_BACKEND']}, users: {args.users}, developers: {args.developers}, "
+          f"apps per cycle: {args.apps}, cycles: {args.cycles}")
+    for name, value in report.items():
+        print(f"{name:<24} {value:10.2f}" if isinstance(value, float) else f"{name:<24} {value:10}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+import hashlib
+import time
+from aiohttp import web
+from typing import Dict, List
+
+
+class FakeStoreglide:
+    # Local stand-in for store.storeglide.com listing pages with ETag support.
+    # New apps are published on top of the listing like on the real site.
+
+    def __init__(self, developers: List[str], apps_per_page: int = 50, pages_deep: int = 10):
+        self.developers = developers
+        self.apps_per_page = apps_per_page
+        self.pages_deep = pages_deep
+        self.apps: List[Dict[str, str]] = list()
+        self.published: Dict[str, float] = dict()
+        self.requests = 0
+        self.not_modified = 0
+        self._counter = 0
+        self._pages: Dict[int, str] = dict()
+
+    def publish(self, count: int) -> List[Dict[str, str]]:
+        now = time.monotonic()
+        new_apps = list()
+        for _ in range(count):
+            self._counter += 1
+            app = {
+                "name": f"Bench App {self._counter}",
+                "author": self.developers[self._counter % len(self.developers)],
+                "countries": "US, CA, AU",
+                "link": f"https://apps.apple.com/app/bench-app/id{1000000000 + self._counter}",
+            }
+            self.published[app["link"]] = now
+            new_apps.append(app)
+        self.apps = list(reversed(new_apps)) + self.apps
+        self.apps = self.apps[:self.apps_per_page * self.pages_deep]
+        self._pages.clear()
+
+        return new_apps
+
+    @property
+    def filled_pages(self) -> int:
+        # Pages with apps on them, the listing fills up as apps are published
+        return max(1, -(-len(self.apps) // self.apps_per_page))
+
+    def render_page(self, page: int) -> str:
+        if page not in self._pages:
+            start = (page - 1) * self.apps_per_page
+            items = "".join(
+                '<li class="app"><div class="info">'
+                f'<span class="name">{app["name"]}</span>'
+                f'<span class="author">by {app["author"]}</span>'
+                f'<span class="countries">\n  {app["countries"]}\n</span></div>'
+                f'<a class="download" href="{app["link"]}">Download</a></li>\n'
+                for app in self.apps[start:start + self.apps_per_page]
+            )
+            self._pages[page] = (
+                "<!DOCTYPE html><html><head><title>StoreGlide</title></head><body>"
+                f'<ul class="apps">\n{items}</ul></body></html>'
+            )
+        return self._pages[page]
+
+    async def handle_listing(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        page = int(request.query.get("page", 1))
+        body = self.render_page(page)
+        etag = '"' + hashlib.sha1(body.encode()).hexdigest() + '"'
+        if request.headers.get("If-None-Match") == etag:
+            self.not_modified += 1
+            return web.Response(status=304, headers={"ETag": etag})
+        return web.Response(text=body, content_type="text/html", headers={"ETag": etag})
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get("/", self.handle_listing)
+        return app
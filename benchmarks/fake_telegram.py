@@ -0,0 +1,62 @@
+import asyncio
+import random
+import time
+from aiohttp import web
+from typing import List, Tuple
+
+
+class FakeTelegram:
+    # Local stand-in for the Telegram Bot API. Records sent messages and can
+    # add latency and answer sendMessage with 429 flood control errors.
+
+    def __init__(self, latency_secs: float = 0.0, error_rate: float = 0.0, retry_after: int = 1):
+        self.latency_secs = latency_secs
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.sent: List[Tuple[float, int, str]] = list()
+        self.calls = 0
+        self.rate_limited = 0
+        self._message_id = 0
+
+    def make_message(self, chat_id: int, text: str) -> dict:
+        self._message_id += 1
+        return {
+            "message_id": self._message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "text": text,
+        }
+
+    async def handle_method(self, request: web.Request) -> web.Response:
+        self.calls += 1
+        method = request.match_info["method"]
+        data = await request.post()
+        if self.latency_secs:
+            await asyncio.sleep(self.latency_secs)
+
+        if method == "sendMessage" and random.random() < self.error_rate:
+            self.rate_limited += 1
+            return web.json_response({
+                "ok": False,
+                "error_code": 429,
+                "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after},
+            }, status=429)
+
+        chat_id = int(data.get("chat_id", 0))
+        text = data.get("text", "")
+        if method == "sendMessage":
+            self.sent.append((time.monotonic(), chat_id, text))
+            result = self.make_message(chat_id, text)
+        elif method == "editMessageText":
+            result = self.make_message(chat_id, text)
+        elif method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle_method)
+        return app
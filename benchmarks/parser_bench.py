@@ -0,0 +1,54 @@
+import sys
+import timeit
+from bs4 import BeautifulSoup
+from pathlib import Path
+from typing import Dict, List
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from parsing import parse_apps  # noqa: E402
+
+FIXTURES_DIR = Path(__file__).resolve().parent / "fixtures"
+ROUNDS = 50
+
+
+def parse_apps_full_dom(page: str) -> List[Dict[str, str]]:
+    # Parser used by the spider before the restricted parse
+    soup = BeautifulSoup(page, 'html.parser')
+    apps = soup.find_all('li', {'class': 'app'})
+    parsed_apps = []
+    for app in apps:
+        name = app.find('span', {'class': 'name'}).text
+        author = app.find('span', {'class': 'author'}).text.replace('by ', '')
+        countries = app.find('span', {'class': 'countries'}).text.strip()
+        link = app.find('a', {'class': 'download'}).get('href')
+        app_info = {
+            'name': name,
+            'author': author,
+            'countries': countries,
+            'link': link
+        }
+        parsed_apps.append(app_info)
+    return parsed_apps
+
+
+def main():
+    pages = [path.read_text() for path in sorted(FIXTURES_DIR.glob("storeglide_page_*.html"))]
+    if not pages:
+        sys.exit(f"No fixtures found in {FIXTURES_DIR}")
+
+    for page in pages:
+        expected = parse_apps_full_dom(page)
+        if [app._asdict() for app in parse_apps(page)] != expected:
+            sys.exit("Parsers output differs")
+    apps_count = sum(len(parse_apps(page)) for page in pages)
+    print(f"{len(pages)} pages, {apps_count} apps, {ROUNDS} rounds")
+
+    for title, parser in (("full dom", parse_apps_full_dom), ("streaming", parse_apps)):
+        elapsed = timeit.timeit(lambda: [parser(page) for page in pages], number=ROUNDS)
+        per_page_ms = elapsed / (ROUNDS * len(pages)) * 1000
+        print(f"{title:<10} {per_page_ms:8.2f} ms/page {ROUNDS * len(pages) / elapsed:8.1f} pages/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,28 +1,27 @@
 import asyncio
+import hashlib
 import logging
+import os
 import pymongo.errors
-import json
 import signal
 
-from aiogram import Bot, Dispatcher, executor, types
+from aiogram import Bot, Dispatcher, types
 from aiogram.dispatcher.filters.state import State, StatesGroup
-from time import sleep
-
-import database as db
-
-SECRETS_FILE = "secrets/credentials.json"
-with open(SECRETS_FILE) as file:
-    secrets = json.load(file)
-
-
-PROXY_HOST = secrets["proxy_host"]
-PROXY_PORT = secrets["proxy_port"]
-PROXY_USER = secrets["proxy_user"]
-PROXY_PASS = secrets["proxy_pass"]
-PROXY_PROTO = "socks5"
-PROXY_URL = f"{PROXY_PROTO}://{PROXY_USER}:{PROXY_PASS}@{PROXY_HOST}:{PROXY_PORT}"
-
-API_TOKEN = secrets["api_token"]
+from aiogram.dispatcher.middlewares import BaseMiddleware
+from aiogram.utils.exceptions import TelegramAPIError
+from aiohttp import ClientError, web
+from datetime import datetime, timedelta
+from typing import Dict, Hashable, List, Optional, Tuple
+
+from storage import db
+from cache import LRUCache
+from developers import DeveloperIndex, normalize_developer
+from matching import AUTHOR_PREFIXES, AUTHORS, COUNTRIES, KEYWORDS, SUBSCRIPTION_FIELDS, normalize_subscription
+from instrumentation import Counter, setup_logging, start_metrics_server, stop_logging
+from profiling import install_profiling_handler
+from search_cache import search_cache
+from telegram import API_TOKEN, bot, bot_pool
+from workers import KeyedWorkerPool
 
 
 HELLO_MESSAGE = """
@@ -31,10 +30,14 @@ Commands:
 /help - show this message
 /register - register for notifications
 /add %DEVELOPER% - add developer to notifications
-/del %DEVELOPER% - delete developer from notifications
-/del - delete developer (choose from buttons)
-/list - list of developers configured for notification
+/add %DEVELOPER%* - add all developers starting with it
+/keyword %WORD% - notify about apps with the word in the name
+/country %COUNTRY% - notify only about apps released for the country
+/del %SUBSCRIPTION% - delete subscription as shown by /list
+/del - delete subscription (choose from buttons)
+/list - list of subscriptions configured for notification
 /search %DEVELOPER% - search for apps by developer in last 5 days cache
+/history %DEVELOPER% - latest apps by developer in last 180 days archive
 /start - show this message
 /stop - unregister for notifications
 """
@@ -49,20 +52,144 @@ Notifications stopped.
 RETROSEARCH_SKIP = 0
 RETROSEARCH_LIMIT = 5
 
+DEVELOPER_INDEX_TTL_SECS = 300
+
+SEARCH_PAGE_SIZE = 5
+FOUND_APP_MESSAGE = "Found at {created}. App {name} from {author} released for {countries}:\n{link}"
+
+HISTORY_DAYS = 180
+HISTORY_SIZE = 10
+# Shorter prefixes match too many authors to go through their whole history
+HISTORY_MIN_PREFIX_LEN = 3
+SEARCH_CALLBACK_PREFIX = "srchpg__"
+CALLBACK_DATA_MAX_BYTES = 64
+# Queries too long for the callback data are kept here behind a short id
+SEARCH_QUERY_CALLBACK_PREFIX = "srchq__"
+SEARCH_QUERIES_CACHE_SIZE = 10000
+SEARCH_QUERIES_CACHE_TTL_SECS = 24 * 60 * 60
+
+SUBSCRIPTIONS_CACHE_SIZE = 10000
+SUBSCRIPTIONS_CACHE_TTL_SECS = 600
+
+PREFIX_SUFFIX = "*"
+KEYWORD_LABEL = "keyword: "
+COUNTRY_LABEL = "country: "
+
+
+METRICS_PORT = 9103
+
+# Webhook mode gets updates pushed by Telegram to a secret path of the bot
+# server. Polling is the default and the fallback when the webhook can't be set.
+BOT_MODE = os.environ.get("BOT_MODE", "polling")
+WEBHOOK_MODE = "webhook"
+WEBHOOK_URL = os.environ.get("BOT_WEBHOOK_URL", "")
+WEBHOOK_HOST = "0.0.0.0"
+WEBHOOK_PORT = int(os.environ.get("BOT_WEBHOOK_PORT", 8080))
+WEBHOOK_PATH = "/webhook/" + hashlib.sha256(API_TOKEN.encode()).hexdigest()
+
+# Webhook updates run concurrently, updates of one chat in order
+UPDATE_WORKERS = 16
+UPDATE_MAX_PENDING = 1000
+UPDATE_DRAIN_SECS = 10
+
+COMMANDS = Counter("bot_commands_total", "Bot commands handled")
 
 # Configure logging
-logging.basicConfig(level=logging.INFO)
+setup_logging()
 
-# Initialize bot and dispatcher
-bot = Bot(token=API_TOKEN, proxy=PROXY_URL)
+# Initialize dispatcher
 loop = db.loop
 dp = Dispatcher(bot, loop=loop)
+developer_index = DeveloperIndex(ttl_secs=DEVELOPER_INDEX_TTL_SECS)
+# Sorted subscription lists by cid, the bot is the only writer of the lists
+subscriptions_cache = LRUCache(SUBSCRIPTIONS_CACHE_SIZE, SUBSCRIPTIONS_CACHE_TTL_SECS)
+search_queries = LRUCache(SEARCH_QUERIES_CACHE_SIZE, SEARCH_QUERIES_CACHE_TTL_SECS)
 
 
 class Form(StatesGroup):
     dev = State()
 
 
+class MetricsMiddleware(BaseMiddleware):
+    async def on_process_message(self, message: types.Message, data: dict):
+        command = message.get_command(pure=True)
+        if command:
+            COMMANDS.inc(command=command)
+
+
+dp.middleware.setup(MetricsMiddleware())
+
+
+def format_subscription(field: str, value: str) -> str:
+    if field == AUTHOR_PREFIXES:
+        return value + PREFIX_SUFFIX
+    if field == KEYWORDS:
+        return KEYWORD_LABEL + value
+    if field == COUNTRIES:
+        return COUNTRY_LABEL + value
+    return value
+
+
+def parse_subscription(text: str) -> Tuple[str, str]:
+    # Reverse of format_subscription, used by /del
+    text = text.strip()
+    if text.lower().startswith(KEYWORD_LABEL.strip()):
+        field, value = KEYWORDS, text[len(KEYWORD_LABEL.strip()):]
+    elif text.lower().startswith(COUNTRY_LABEL.strip()):
+        field, value = COUNTRIES, text[len(COUNTRY_LABEL.strip()):]
+    elif text.endswith(PREFIX_SUFFIX):
+        field, value = AUTHOR_PREFIXES, text.rstrip(PREFIX_SUFFIX)
+    else:
+        field, value = AUTHORS, text
+    return field, normalize_subscription(field, value)
+
+
+def sort_subscriptions(subscriptions: Dict[str, List[str]]) -> Dict[str, List[str]]:
+    return {field: sorted(values) for field, values in subscriptions.items()}
+
+
+def list_subscriptions(subscriptions: Dict[str, List[str]]) -> List[Tuple[str, str]]:
+    return [(field, value) for field in SUBSCRIPTION_FIELDS for value in subscriptions[field]]
+
+
+async def get_subscriptions(cid: int) -> Dict[str, List[str]]:
+    subscriptions = subscriptions_cache.get(cid)
+    if subscriptions is None:
+        subscriptions = sort_subscriptions(await db.get_subscriptions(cid))
+        subscriptions_cache.set(cid, subscriptions)
+    return subscriptions
+
+
+async def add_subscription(cid: int, field: str, value: str) -> Dict[str, List[str]]:
+    try:
+        subscriptions = sort_subscriptions(await db.add_subscription(cid, field, value))
+    except pymongo.errors.DuplicateKeyError:
+        subscriptions_cache.invalidate(cid)
+        raise
+    subscriptions_cache.set(cid, subscriptions)
+    return subscriptions
+
+
+async def del_subscription(cid: int, field: str, value: str) -> Dict[str, List[str]]:
+    subscriptions = sort_subscriptions(await db.del_subscription(cid, field, value))
+    subscriptions_cache.set(cid, subscriptions)
+    return subscriptions
+
+
+async def get_developer_index() -> DeveloperIndex:
+    if developer_index.is_stale():
+        developer_index.rebuild(await db.get_author_keys())
+    return developer_index
+
+
+async def get_suggestions_text(dev: str) -> str:
+    index = await get_developer_index()
+    suggestions = index.suggest(dev)
+    if not suggestions:
+        return ""
+    return "Did you mean:\n" + "\n".join(suggestions)
+
+
 @dp.message_handler(commands=['start', 'help'])
 async def start_handler(message: types.Message):
     await message.answer(HELLO_MESSAGE)
@@ -93,14 +220,23 @@ async def add_handler(message: types.Message):
         return None
 
     dev = ' '.join(message_text[1:])
+    if dev.endswith(PREFIX_SUFFIX):
+        await add_subscription_handler(message, AUTHOR_PREFIXES, dev.rstrip(PREFIX_SUFFIX))
+        return None
+
     try:
-        await db.add_developer(message.chat.id, dev.lower())
+        await add_subscription(message.chat.id, AUTHORS, normalize_developer(dev))
     except pymongo.errors.DuplicateKeyError:
         text = f"{dev} already added"
     else:
         text = "Done"
 
     await message.answer(text)
+    index = await get_developer_index()
+    if normalize_developer(dev) not in index:
+        suggestions = await get_suggestions_text(dev)
+        if suggestions:
+            await message.answer(f"{dev} has no apps in the last 5 days. " + suggestions)
     if dev not in text:
         callback_data = f"rsrch__"
         markup = types.InlineKeyboardMarkup()
@@ -111,26 +247,68 @@ async def add_handler(message: types.Message):
         await message.answer("Want to start retrospective search?", reply_markup=markup)
 
 
+async def add_subscription_handler(message: types.Message, field: str, value: str):
+    value = normalize_subscription(field, value)
+    if not value:
+        await message.answer("Subscription can't be empty")
+        return None
+    try:
+        await add_subscription(message.chat.id, field, value)
+    except pymongo.errors.DuplicateKeyError:
+        text = f"{format_subscription(field, value)} already added"
+    else:
+        text = "Done"
+
+    await message.answer(text)
+
+
+@dp.message_handler(commands=['keyword'])
+async def keyword_handler(message: types.Message):
+    message_text = message.text.split()
+    if len(message_text) < 2:
+        await message.answer("You need to specify keyword")
+        return None
+
+    await add_subscription_handler(message, KEYWORDS, ' '.join(message_text[1:]))
+
+
+@dp.message_handler(commands=['country'])
+async def country_handler(message: types.Message):
+    message_text = message.text.split()
+    if len(message_text) < 2:
+        await message.answer("You need to specify country")
+        return None
+
+    await add_subscription_handler(message, COUNTRIES, ' '.join(message_text[1:]))
+
+
+def get_subscription_hash(field: str, value: str) -> str:
+    # Short enough for the callback data, tells the button's entry apart
+    return hashlib.sha1(f"{field}:{value}".encode()).hexdigest()[:8]
+
+
 @dp.message_handler(commands=['del'])
 async def del_handler(message: types.Message):
     message_text = message.text.split()
     if len(message_text) < 2:
-        devs = sorted(await db.get_developers(message.chat.id))
-        if devs:
+        subscriptions = list_subscriptions(await get_subscriptions(message.chat.id))
+        if subscriptions:
             markup = types.InlineKeyboardMarkup()
             keyboard = [
                 types.inline_keyboard.InlineKeyboardButton(
-                    text=d, callback_data=f"devtodel__{devs.index(d)}") for d in devs
+                    text=format_subscription(field, value),
+                    callback_data=f"devtodel__{i}__{get_subscription_hash(field, value)}",
+                ) for i, (field, value) in enumerate(subscriptions)
             ]
             markup.add(*keyboard)
-            await message.answer("Choose dev to del:", reply_markup=markup)
+            await message.answer("Choose subscription to del:", reply_markup=markup)
 
         else:
             await message.answer("Nothing to delete")
 
         return None
-    dev = message_text[1]
-    await db.del_developer(message.chat.id, dev)
+    field, value = parse_subscription(' '.join(message_text[1:]))
+    await del_subscription(message.chat.id, field, value)
     text = "Done"
 
     await message.answer(text)
@@ -138,9 +316,9 @@ async def del_handler(message: types.Message):
 
 @dp.message_handler(commands=['list'])
 async def list_handler(message: types.Message):
-    devs = sorted(await db.get_developers(message.chat.id))
-    devs = '\n'.join(devs)
-    text = "Your developers notification list:\n\n" + devs
+    subscriptions = list_subscriptions(await get_subscriptions(message.chat.id))
+    subscriptions = '\n'.join(format_subscription(field, value) for field, value in subscriptions)
+    text = "Your subscriptions notification list:\n\n" + subscriptions
 
     await message.answer(text)
 
@@ -155,27 +333,151 @@ async def search_handler(message: types.Message):
         return None
 
     dev = ' '.join(message_text[1:])
-    apps = db.search_apps_by_dev(dev)
-    found_flag = False
-    async for app in apps:
-        text = "Found at {created}. App {name} from {author} released for {countries}:\n{link}".format(**app)
-        await message.answer(text)
-        found_flag = True
+    for prefix in (False, True):
+        total, apps = await search_cache.search_page(dev, prefix=prefix, limit=SEARCH_PAGE_SIZE)
+        if apps:
+            text, markup = render_search_page(dev, prefix, 0, total, apps)
+            await message.answer(text, reply_markup=markup, disable_web_page_preview=True)
+            return None
+
+    text = "Nothing found"
+    suggestions = await get_suggestions_text(dev)
+    if suggestions:
+        text += ". " + suggestions
+    await message.answer(text)
+
+
+async def get_history(dev: str, prefix: bool, since: datetime) -> List[Dict]:
+    # Latest HISTORY_SIZE apps, apps about to expire are in both and the hot
+    # copy is the fresher one
+    apps = await search_cache.get(dev, prefix=prefix)
+    if apps is None:
+        apps = await db.search_latest_apps_by_dev(dev, prefix=prefix, limit=HISTORY_SIZE).to_list(None)
+    apps = sorted(apps, key=lambda app: app["created"], reverse=True)[:HISTORY_SIZE]
+    links = {app["link"] for app in apps}
+    archived = await db.search_archive(dev, since, datetime.now(), prefix=prefix, limit=HISTORY_SIZE)
+    apps += [app for app in archived if app["link"] not in links]
+    apps.sort(key=lambda app: app["created"], reverse=True)
+    return apps[:HISTORY_SIZE]
+
+
+@dp.message_handler(commands=['history'])
+async def history_handler(message: types.Message):
+    message_text = message.text.strip().split()
+    if len(message_text) < 2:
+        await message.answer("You need to specify developer")
+        return None
+
+    dev = ' '.join(message_text[1:])
+    since = datetime.now() - timedelta(days=HISTORY_DAYS)
+    for prefix in (False, True):
+        if prefix and len(normalize_developer(dev.strip('"'))) < HISTORY_MIN_PREFIX_LEN:
+            break
+        apps = await get_history(dev, prefix, since)
+        if apps:
+            texts = [FOUND_APP_MESSAGE.format(**app) for app in apps]
+            text = f"Latest {len(texts)} apps for {dev} in last {HISTORY_DAYS} days:\n\n" + "\n\n".join(texts)
+            await message.answer(text, disable_web_page_preview=True)
+            return None
+
+    await message.answer("Nothing found")
+
+
+def get_search_callback_data(dev: str, prefix: bool, skip: int) -> str:
+    data = f"{SEARCH_CALLBACK_PREFIX}{skip}__{int(prefix)}__{dev}"
+    if len(data.encode()) <= CALLBACK_DATA_MAX_BYTES:
+        return data
+    query_id = hashlib.sha1(f"{int(prefix)}{dev}".encode()).hexdigest()[:16]
+    search_queries.set(query_id, (dev, prefix))
+    return f"{SEARCH_QUERY_CALLBACK_PREFIX}{skip}__{query_id}"
+
+
+def parse_search_callback_data(data: str) -> Optional[Tuple[str, bool, int]]:
+    # None when the stored query is gone
+    if data.startswith(SEARCH_QUERY_CALLBACK_PREFIX):
+        skip, query_id = data[len(SEARCH_QUERY_CALLBACK_PREFIX):].split("__", 1)
+        query = search_queries.get(query_id)
+        if query is None:
+            return None
+        dev, prefix = query
+        return dev, prefix, int(skip)
+    skip, prefix, dev = data[len(SEARCH_CALLBACK_PREFIX):].split("__", 2)
+    return dev, bool(int(prefix)), int(skip)
+
+
+def render_search_page(dev: str, prefix: bool, skip: int, total: int, apps: List[Dict]):
+    texts = [FOUND_APP_MESSAGE.format(**app) for app in apps]
+    last = skip + len(texts)
+    text = f"Found {total} apps for {dev}, showing {skip + 1}-{last}:\n\n" + "\n\n".join(texts)
+
+    buttons = list()
+    if skip > 0:
+        prev_skip = max(skip - SEARCH_PAGE_SIZE, 0)
+        buttons.append(types.InlineKeyboardButton(
+            text="< Prev", callback_data=get_search_callback_data(dev, prefix, prev_skip)
+        ))
+    if last < total:
+        buttons.append(types.InlineKeyboardButton(
+            text="Next >", callback_data=get_search_callback_data(dev, prefix, last)
+        ))
+    markup = types.InlineKeyboardMarkup()
+    if buttons:
+        markup.row(*buttons)
+
+    return text, markup
+
+
+@dp.callback_query_handler(lambda callback_query: callback_query.data.startswith(
+    (SEARCH_CALLBACK_PREFIX, SEARCH_QUERY_CALLBACK_PREFIX)
+))
+async def search_page_callback_query(callback_query: types.CallbackQuery):
+    # Every path answers the query, the client shows a spinner until then
+    try:
+        query = parse_search_callback_data(callback_query.data)
+    except ValueError:
+        query = None
+    if query is None:
+        await callback_query.message.edit_text("Search expired, use /search again")
+        await callback_query.answer("Search expired, use /search again")
+        return None
+    dev, prefix, skip = query
+    total, apps = await search_cache.search_page(dev, prefix=prefix, skip=skip, limit=SEARCH_PAGE_SIZE)
+    if not apps and total:
+        # Results may have expired since the previous page
+        skip = (total - 1) // SEARCH_PAGE_SIZE * SEARCH_PAGE_SIZE
+        total, apps = await search_cache.search_page(dev, prefix=prefix, skip=skip, limit=SEARCH_PAGE_SIZE)
+    if not apps:
+        await callback_query.message.edit_text("Nothing found")
+        await callback_query.answer("Nothing found")
+        return None
 
-    if not found_flag:
-        text = "Nothing found"
-        await message.answer(text)
+    text, markup = render_search_page(dev, prefix, skip, total, apps)
+    await callback_query.message.edit_text(text, reply_markup=markup, disable_web_page_preview=True)
+    await callback_query.answer()
 
 
-@dp.callback_query_handler(lambda callback_query: "devtodel__" in callback_query.data)
+@dp.callback_query_handler(lambda callback_query: callback_query.data.startswith("devtodel__"))
 async def delete_dev_callback_query(callback_query: types.CallbackQuery):
-    index = int(callback_query.data.split("__")[1])
-    devs = sorted(await db.get_developers(callback_query.message.chat.id))
-    dev = devs[index]
-    text = f"Your choice is:\n {dev}"
+    parts = callback_query.data.split("__", 2)
+    # Buttons sent before the hash was added carry only the index
+    if len(parts) != 3 or not parts[1].isdigit():
+        await callback_query.message.edit_text("Your list has changed, use /del again")
+        await callback_query.answer()
+        return None
+    _, index, subscription_hash = parts
+    index = int(index)
+    subscriptions = list_subscriptions(await get_subscriptions(callback_query.message.chat.id))
+    # The entry at the index may be another one if the list has changed
+    if index >= len(subscriptions) or get_subscription_hash(*subscriptions[index]) != subscription_hash:
+        await callback_query.message.edit_text("Your list has changed, use /del again")
+        await callback_query.answer()
+        return None
+    field, value = subscriptions[index]
+    text = f"Your choice is:\n {format_subscription(field, value)}"
     await callback_query.message.edit_text(text)
-    await db.del_developer(callback_query.message.chat.id, dev)
+    await del_subscription(callback_query.message.chat.id, field, value)
     await callback_query.message.reply("Deleted")
+    await callback_query.answer()
 
 
 @dp.callback_query_handler(lambda callback_query: "rsrch__" in callback_query.data)
@@ -191,26 +493,119 @@ async def retro_search_callback_query(callback_query: types.CallbackQuery):
     )
 
 
+def get_update_key(update: types.Update) -> Hashable:
+    message = update.message or update.edited_message or update.channel_post or update.edited_channel_post
+    if message is None and update.callback_query is not None:
+        message = update.callback_query.message
+    if message is not None:
+        return message.chat.id
+    # Updates without a chat need no ordering
+    return update.update_id
+
+
+async def process_update(update: types.Update):
+    await dp.process_update(update)
+
+
+update_workers = KeyedWorkerPool(process_update, UPDATE_WORKERS, UPDATE_MAX_PENDING)
+webhook_runner: Optional[web.AppRunner] = None
+
+
+async def webhook_handler(request: web.Request) -> web.Response:
+    update = types.Update(**(await request.json()))
+    await update_workers.submit(get_update_key(update), update)
+    return web.Response()
+
+
+async def start_webhook():
+    global webhook_runner
+    # Workers inherit the context of the task starting them
+    Dispatcher.set_current(dp)
+    Bot.set_current(dp.bot)
+    update_workers.start()
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, webhook_handler)
+    webhook_runner = web.AppRunner(app)
+    await webhook_runner.setup()
+    await web.TCPSite(webhook_runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+    await dp.bot.set_webhook(WEBHOOK_URL + WEBHOOK_PATH)
+    logging.info(f"Receiving updates through webhook on {WEBHOOK_HOST}:{WEBHOOK_PORT}")
+
+
+async def stop_webhook():
+    # Stops accepting updates and lets the queued ones finish
+    global webhook_runner
+    if webhook_runner is not None:
+        logging.info("Stopping webhook server")
+        await webhook_runner.cleanup()
+        webhook_runner = None
+    if update_workers.accepting:
+        logging.info("Draining queued updates")
+        await update_workers.drain(UPDATE_DRAIN_SECS)
+
+
+async def start_polling():
+    # getUpdates conflicts with a webhook left from webhook mode
+    await dp.reset_webhook(True)
+    await dp.skip_updates()
+    await dp.start_polling()
+
+
+async def start_bot():
+    if BOT_MODE == WEBHOOK_MODE:
+        if not WEBHOOK_URL:
+            logging.error("BOT_WEBHOOK_URL is not set, falling back to polling")
+        else:
+            try:
+                await start_webhook()
+                return None
+            except (TelegramAPIError, ClientError, OSError) as e:
+                logging.error(f"Can't start webhook, falling back to polling: {e!r}")
+                await stop_webhook()
+    await start_polling()
+
+
+async def close():
+    if dp.is_polling():
+        logging.info("Stopping polling")
+        dp.stop_polling()
+        await dp.wait_closed()
+    await dp.storage.close()
+    await dp.storage.wait_closed()
+
+
 async def shutdown(loop, signal=None):
     if signal:
         logging.info(f"Received exit signal {signal.name}")
+    await stop_webhook()
     tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
     [task.cancel() for task in tasks]
     logging.info(f"Cancelling {len(tasks)} tasks")
     await asyncio.gather(*tasks, return_exceptions=True)
+    await close()
+    logging.info("Closing Telegram sessions")
+    await bot_pool.close()
     logging.info(f"Closing database session")
-    db.client.close()
+    db.close()
     logging.info("Done.")
     loop.stop()
 
 
+async def start():
+    await db.wait_ready()
+    await start_metrics_server(METRICS_PORT)
+    await start_bot()
+
+
 if __name__ == '__main__':
-    sleep(5)
     signals = (signal.SIGHUP, signal.SIGTERM, signal.SIGINT)
     for s in signals:
         loop.add_signal_handler(s, lambda s=s: asyncio.create_task(shutdown(loop, signal=s)))
+    install_profiling_handler(loop, "bot")
     try:
-        executor.start_polling(dp, skip_updates=True)
+        loop.create_task(start())
+        loop.run_forever()
     finally:
         logging.info("Successfully shutdown Bot")
         loop.close()
+        stop_logging()
@@ -1,12 +1,21 @@
 import asyncio
+import os
+import re
 import uvloop
 import pymongo.errors
 from bson import ObjectId
-from datetime import datetime
+from collections import defaultdict
+from datetime import datetime, timedelta
 from motor.motor_asyncio import AsyncIOMotorClient
 from motor.core import Collection, Database
+from pymongo import ReturnDocument, UpdateOne
 from pymongo.results import InsertOneResult, UpdateResult
-from typing import Dict
+from typing import Any, Dict, Iterable, List, Optional, Set
+
+from archive import filter_apps, get_bucket, merge_apps, pack_apps, unpack_apps
+from developers import normalize_developer
+from matching import SUBSCRIPTION_FIELDS
+from parsing import App, split_countries
 
 
 USER = "mongo"
@@ -14,71 +23,417 @@ PASSWORD = "mongo"
 HOST = "mongo"
 PORT = "27017"
 
-URI = f"mongodb://{USER}:{PASSWORD}@{HOST}:{PORT}"
+URI = os.environ.get("MONGO_URI", f"mongodb://{USER}:{PASSWORD}@{HOST}:{PORT}")
+
+DUPLICATE_KEY_ERROR_CODE = 11000
+
+# Startup waits for MongoDB with exponential backoff instead of a fixed delay
+SERVER_SELECTION_TIMEOUT_MS = 5000
+READY_TIMEOUT_SECS = 120
+READY_BACKOFF_SECS = 0.5
+READY_BACKOFF_MAX_SECS = 10
 
 asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
 loop = asyncio.get_event_loop()
 
-client = AsyncIOMotorClient(URI, io_loop=loop)
+client = AsyncIOMotorClient(URI, io_loop=loop, serverSelectionTimeoutMS=SERVER_SELECTION_TIMEOUT_MS)
 db: Database = client.storglide
 users_coll: Collection = db.users
 apps_coll: Collection = db.apps
 queue_coll: Collection = db.queue_coll
+pages_coll: Collection = db.pages_coll
+state_coll: Collection = db.state_coll
+outbox_coll: Collection = db.outbox_coll
+leases_coll: Collection = db.leases_coll
+author_versions_coll: Collection = db.author_versions_coll
+archive_coll: Collection = db.archive_coll
+
+DELIVERY_PENDING = "pending"
+DELIVERY_SENDING = "sending"
+DELIVERY_SENT = "sent"
+DELIVERY_FAILED = "failed"
+
+# State document with the counter behind author versions
+SEARCH_VERSION_STATE = "search_version"
+# State document with the creation time the apps are archived up to
+ARCHIVE_STATE = "archive"
+# State document marking the developer subscriptions as normalized
+DEVELOPERS_BACKFILL_STATE = "developers_backfill"
+
+
+async def create_indexes(app_expire_secs: int):
+    # Apps used to be unique by name, the same name may come from two developers
+    try:
+        await apps_coll.drop_index("name_1")
+    except pymongo.errors.OperationFailure:
+        pass
+    await apps_coll.create_index([("link", 1)], unique=True)
+    await apps_coll.create_index([("created", 1)], expireAfterSeconds=app_expire_secs)
+    await apps_coll.create_index([("author_key", 1), ("created", -1)])
+    try:
+        await apps_coll.drop_index("author_text")
+    except pymongo.errors.OperationFailure:
+        pass
+    await users_coll.create_index([("cid", 1)], unique=True)
+    # Subscribers are matched in memory, the developers lookup index is unused
+    try:
+        await users_coll.drop_index("developers_1_active_1_cid_1")
+    except pymongo.errors.OperationFailure:
+        pass
+    await users_coll.create_index([("updated", 1)])
+    await pages_coll.create_index([("url", 1)], unique=True)
+    await outbox_coll.create_index([("status", 1), ("created", 1)])
+    await outbox_coll.create_index([("created", 1)], expireAfterSeconds=app_expire_secs)
+    await queue_coll.create_index([("type", 1), ("lease_until", 1), ("_id", 1)])
+    await author_versions_coll.create_index([("version", 1)])
+    await author_versions_coll.create_index([("updated", 1)], expireAfterSeconds=app_expire_secs)
+    await archive_coll.create_index([("author_key", 1), ("bucket", -1)], unique=True)
+
+
+async def wait_ready(timeout_secs: float = READY_TIMEOUT_SECS):
+    deadline = loop.time() + timeout_secs
+    delay = READY_BACKOFF_SECS
+    while True:
+        try:
+            await client.admin.command("ping")
+            return
+        except pymongo.errors.ConnectionFailure:
+            if loop.time() + delay > deadline:
+                raise
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, READY_BACKOFF_MAX_SECS)
+
+
+def close():
+    client.close()
+
+
+def get_app_fields(app: App) -> Dict[str, str]:
+    fields = app._asdict()
+    fields.update(author_key=normalize_developer(app.author), content_hash=app.content_hash)
+    return fields
+
+
+async def insert_many_skip_duplicates(coll: Collection, docs: List[Dict]) -> List:
+    failed = set()
+    try:
+        await coll.insert_many(docs, ordered=False)
+    except pymongo.errors.BulkWriteError as e:
+        write_errors = e.details.get("writeErrors", [])
+        if any(err["code"] != DUPLICATE_KEY_ERROR_CODE for err in write_errors):
+            raise
+        failed = {err["index"] for err in write_errors}
+    # insert_many assigns _id to the passed documents
+    inserted_ids = [doc["_id"] for i, doc in enumerate(docs) if i not in failed]
 
+    return inserted_ids
 
-async def create_app(app: Dict[str, str]):
-    app_in_db = app.copy()
-    app_in_db.update({"created": datetime.now(), "notified": False})
+
+async def bulk_write_skip_duplicates(coll: Collection, requests: List) -> Dict[str, Any]:
     try:
-        result = await apps_coll.insert_one(app_in_db)
-        result = result.inserted_id
-    except pymongo.errors.DuplicateKeyError:
-        result = None
+        result = await coll.bulk_write(requests, ordered=False)
+        return result.bulk_api_result
+    except pymongo.errors.BulkWriteError as e:
+        # Concurrent upserts of the same document, the other one won
+        if any(err["code"] != DUPLICATE_KEY_ERROR_CODE for err in e.details.get("writeErrors", [])):
+            raise
+        return e.details
+
+
+def get_app_update(app: App, known: Dict) -> Optional[Dict]:
+    fields = get_app_fields(app)
+    if known.get("content_hash") == fields["content_hash"]:
+        return None
+
+    changed = {k: v for k, v in fields.items() if known.get(k) != v}
+    update = {"$set": changed}
+    old_countries = set(split_countries(known["countries"]))
+    new_countries = [c for c in split_countries(app.countries) if c not in old_countries]
+    if new_countries:
+        # Notifier picks the app up again and reports the added countries
+        changed.update(new_countries=new_countries, notified=False)
+        update["$unset"] = {"notified_shards": ""}
+    return update
+
+
+async def create_apps(apps: List[App]) -> Dict[str, Any]:
+    # Only new and changed apps are written, the content hash tells them apart.
+    # Author keys are of the written apps, old ones included for changed authors.
+    result = {"inserted": 0, "updated": 0, "skipped": 0, "inserted_ids": [], "author_keys": []}
+    if not apps:
+        return result
+
+    created = datetime.now()
+    known = await get_known_apps([app.link for app in apps])
+    requests = list()
+    author_keys = set()
+    seen = set()
+    for app in apps:
+        if app.link in seen:
+            continue
+        seen.add(app.link)
+        if app.link not in known:
+            requests.append(UpdateOne(
+                {"link": app.link},
+                {"$set": get_app_fields(app), "$setOnInsert": {"created": created, "notified": False}},
+                upsert=True,
+            ))
+            author_keys.add(normalize_developer(app.author))
+            continue
+        update = get_app_update(app, known[app.link])
+        if update is not None:
+            requests.append(UpdateOne({"_id": known[app.link]["_id"]}, update))
+            author_keys.update((normalize_developer(app.author), known[app.link].get("author_key")))
+
+    if requests:
+        write_result = await bulk_write_skip_duplicates(apps_coll, requests)
+        result.update({
+            "inserted": len(write_result["upserted"]),
+            "updated": write_result["nModified"],
+            "inserted_ids": [upserted["_id"] for upserted in write_result["upserted"]],
+            "author_keys": [key for key in author_keys if key],
+        })
+    result["skipped"] = len(apps) - result["inserted"] - result["updated"]
 
     return result
 
 
-async def change_app_notification_status(app_id: ObjectId, notified: bool):
-    app = {"_id": app_id}
-    query = {"$set": {"notified": notified}}
+def get_shard_query(field: str, shards: Optional[List[int]], shard_count: int) -> Dict:
+    # Shard of a chat is abs(cid) % shard_count, $mod keeps the dividend sign
+    if not shards or shard_count <= 1:
+        return {}
+    remainders = sorted({r for shard in shards for r in (shard, -shard)})
+    return {"$or": [{field: {"$mod": [shard_count, r]}} for r in remainders]}
 
-    result: UpdateResult = await apps_coll.update_one(app, query)
+
+async def mark_apps_notified(app_ids: List[ObjectId], shards: Optional[List[int]] = None,
+                             shard_count: int = 1):
+    apps = {"_id": {"$in": app_ids}}
+    notified = {"$set": {"notified": True}, "$unset": {"new_countries": ""}}
+    if shard_count <= 1:
+        result: UpdateResult = await apps_coll.update_many(apps, notified)
+        return result.modified_count
+
+    # App is notified when every shard has fanned it out
+    query = {"$addToSet": {"notified_shards": {"$each": shards}}}
+    await apps_coll.update_many(apps, query)
+    done = dict(apps, notified_shards={"$all": list(range(shard_count))})
+    result: UpdateResult = await apps_coll.update_many(done, notified)
     return result.modified_count
 
 
-async def get_app(app_id: ObjectId):
-    query = {"_id": app_id}
-    return await apps_coll.find_one(query)
+async def get_known_apps(links: List[str]) -> Dict[str, Dict]:
+    query = {"link": {"$in": links}}
+    projection = App._fields + ("author_key", "content_hash")
+    cursor = apps_coll.find(query, projection)
 
+    return {app["link"]: app async for app in cursor}
 
-def get_not_notified_apps():
+
+def get_not_notified_apps(shards: Optional[List[int]] = None):
     query = {"notified": False}
+    if shards:
+        query["notified_shards"] = {"$not": {"$all": shards}}
     cursor = apps_coll.find(query)
 
     return cursor
 
 
-def search_apps_by_dev(dev_string: str):
-    if not dev_string.startswith('"') and not dev_string.endswith('"'):
-        dev_string = '"' + dev_string + '"'
+def watch_new_apps(resume_after: Optional[Dict] = None, max_await_time_ms: Optional[int] = None):
+    # New apps and apps released for more countries
+    pipeline = [{"$match": {"$or": [
+        {"operationType": "insert"},
+        {"operationType": "update", "updateDescription.updatedFields.new_countries": {"$exists": True}},
+    ]}}]
+    stream = apps_coll.watch(
+        pipeline, resume_after=resume_after, max_await_time_ms=max_await_time_ms
+    )
+
+    return stream
 
-    query = {
-        "$text": {"$search": dev_string}
-    }
-    score = {
-        "score": {"$meta": "textScore"}
-    }
-    cursor = apps_coll.find(query, score)
-    cursor.sort([('score', {"$meta": "textScore"})])
+
+def get_dev_query(dev_string: str, prefix: bool = False) -> Dict:
+    key = normalize_developer(dev_string.strip('"'))
+    if prefix:
+        # Anchored case sensitive regex is an index range scan
+        return {"author_key": {"$regex": "^" + re.escape(key)}}
+    return {"author_key": key}
+
+
+def search_apps_by_dev(dev_string: str, prefix: bool = False, skip: int = 0, limit: int = 0):
+    query = get_dev_query(dev_string, prefix)
+    cursor = apps_coll.find(query)
+    cursor.sort([("author_key", pymongo.ASCENDING), ("created", pymongo.DESCENDING)])
+    cursor.skip(skip).limit(limit)
+
+    return cursor
+
+
+async def count_apps_by_dev(dev_string: str, prefix: bool = False) -> int:
+    query = get_dev_query(dev_string, prefix)
+    return await apps_coll.count_documents(query)
+
+
+def search_latest_apps_by_dev(dev_string: str, prefix: bool = False, limit: int = 0):
+    # Newest first across authors, a prefix sorts the matching apps in memory
+    query = get_dev_query(dev_string, prefix)
+    cursor = apps_coll.find(query)
+    cursor.sort("created", pymongo.DESCENDING).limit(limit)
+
+    return cursor
+
+
+def get_expiring_apps(since: Optional[datetime], until: datetime):
+    query = {"created": {"$lt": until}}
+    if since is not None:
+        query["created"]["$gte"] = since
+    projection = App._fields + ("author_key", "created")
+    cursor = apps_coll.find(query, projection)
+    cursor.sort("created", pymongo.ASCENDING)
 
     return cursor
 
 
+async def archive_apps(apps: List[Dict], bucket_days: int) -> int:
+    # Merges apps into the compressed buckets of their authors
+    by_bucket = defaultdict(list)
+    for app in apps:
+        by_bucket[(app["author_key"], get_bucket(app["created"], bucket_days))].append(app)
+    if not by_bucket:
+        return 0
+
+    query = {"$or": [{"author_key": key, "bucket": bucket} for key, bucket in by_bucket]}
+    cursor = archive_coll.find(query, ("author_key", "bucket", "apps"))
+    archived = {(doc["author_key"], doc["bucket"]): unpack_apps(doc["apps"]) async for doc in cursor}
+    updated = datetime.now()
+    requests = list()
+    for (key, bucket), bucket_apps in by_bucket.items():
+        merged = merge_apps(archived.get((key, bucket), []), bucket_apps)
+        fields = {
+            "end": bucket + timedelta(days=bucket_days),
+            "count": len(merged),
+            "apps": pack_apps(merged),
+            "updated": updated,
+        }
+        requests.append(UpdateOne({"author_key": key, "bucket": bucket}, {"$set": fields}, upsert=True))
+    await archive_coll.bulk_write(requests, ordered=False)
+
+    return len(apps)
+
+
+async def search_archive(dev_string: str, since: datetime, until: datetime, prefix: bool = False,
+                         limit: int = 0) -> List[Dict]:
+    # Buckets overlapping the range, bucket width may have changed over time.
+    # With a limit the newest buckets are read until no older one can have
+    # any of the latest limit apps.
+    query = get_dev_query(dev_string, prefix)
+    query.update(end={"$gt": since}, bucket={"$lt": until})
+    cursor = archive_coll.find(query, ("end", "apps"))
+    cursor.sort("end", pymongo.DESCENDING)
+
+    found = list()
+    async for doc in cursor:
+        if limit and len(found) >= limit and found[limit - 1]["created"] >= doc["end"]:
+            break
+        found += filter_apps(unpack_apps(doc["apps"]), since, until)
+        found.sort(key=lambda app: app["created"], reverse=True)
+    return found
+
+
+async def get_archived_until() -> Optional[datetime]:
+    state = await state_coll.find_one({"_id": ARCHIVE_STATE})
+    return state["archived_until"] if state else None
+
+
+async def save_archived_until(archived_until: datetime):
+    state = {"_id": ARCHIVE_STATE}
+    query = {"$set": {"archived_until": archived_until}}
+
+    result: UpdateResult = await state_coll.update_one(state, query, upsert=True)
+    return result.modified_count
+
+
+async def bump_author_versions(author_keys: Iterable[str]) -> Optional[int]:
+    # Gives the authors the next search version, search caches drop results
+    # of authors with versions newer than the one they have seen
+    author_keys = list(author_keys)
+    if not author_keys:
+        return None
+    state = await state_coll.find_one_and_update(
+        {"_id": SEARCH_VERSION_STATE},
+        {"$inc": {"version": 1}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER,
+    )
+    version = state["version"]
+    updated = datetime.now()
+    requests = [
+        UpdateOne({"_id": key}, {"$set": {"version": version, "updated": updated}}, upsert=True)
+        for key in author_keys
+    ]
+    await author_versions_coll.bulk_write(requests, ordered=False)
+    return version
+
+
+async def get_search_version() -> int:
+    state = await state_coll.find_one({"_id": SEARCH_VERSION_STATE})
+    return state["version"] if state else 0
+
+
+async def get_author_versions(since: int) -> Dict[str, int]:
+    # The since version is included, it may have been read half written
+    cursor = author_versions_coll.find({"version": {"$gte": since}}, {"version": 1})
+    return {doc["_id"]: doc["version"] async for doc in cursor}
+
+
+async def get_author_keys() -> List[str]:
+    return await apps_coll.distinct("author_key")
+
+
+async def backfill_author_keys():
+    query = {"author_key": {"$exists": False}}
+    projection = {"author": 1}
+    requests = [
+        UpdateOne({"_id": app["_id"]}, {"$set": {"author_key": normalize_developer(app["author"])}})
+        async for app in apps_coll.find(query, projection)
+    ]
+    if not requests:
+        return 0
+
+    result = await apps_coll.bulk_write(requests, ordered=False)
+    return result.modified_count
+
+
+async def backfill_developer_keys():
+    # Subscriptions saved before normalize_developer were only lowercased,
+    # they are rewritten once so they keep matching the app author keys
+    if await state_coll.find_one({"_id": DEVELOPERS_BACKFILL_STATE}):
+        return 0
+    query = {"developers.0": {"$exists": True}}
+    projection = {"developers": 1}
+    now = datetime.now()
+    requests = list()
+    async for user in users_coll.find(query, projection):
+        # Two old entries may normalize to the same key
+        developers = list(dict.fromkeys(normalize_developer(dev) for dev in user["developers"]))
+        if developers != user["developers"]:
+            requests.append(UpdateOne({"_id": user["_id"]}, {"$set": {"developers": developers, "updated": now}}))
+    modified = 0
+    if requests:
+        result = await users_coll.bulk_write(requests, ordered=False)
+        modified = result.modified_count
+    await state_coll.update_one(
+        {"_id": DEVELOPERS_BACKFILL_STATE}, {"$set": {"backfilled": now}}, upsert=True
+    )
+    return modified
+
+
 async def create_user(cid: int):
     query = {
         "cid": cid,
         "active": True,
-        "developers": []
+        "developers": [],
+        "updated": datetime.now(),
     }
 
     result: InsertOneResult = await users_coll.insert_one(query)
@@ -87,51 +442,59 @@ async def create_user(cid: int):
 
 async def change_user_status(cid: int, active: bool):
     user = {"cid": cid}
-    query = {"$set": {"active": active}}
+    query = {"$set": {"active": active, "updated": datetime.now()}}
 
     result: UpdateResult = await users_coll.update_one(user, query)
     return result.modified_count
 
 
-async def get_user(cid: int):
-    user = {"cid": cid}
-
-    result = await users_coll.find_one(user)
-    return result
+def get_updated_subscribers(since: Optional[datetime] = None, shards: Optional[List[int]] = None,
+                            shard_count: int = 1):
+    # Users changed since the previous sync, all of them for the first one
+    query = {"updated": {"$gte": since}} if since else {}
+    query.update(get_shard_query("cid", shards, shard_count))
+    projection = ("cid", "active") + SUBSCRIPTION_FIELDS
+    cursor = users_coll.find(query, projection)
 
+    return cursor
 
-def get_users_by_developer(dev: str):
-    query = {"developers": dev}
-    cursor = users_coll.find(query)
 
-    return cursor
+def get_subscriptions_from_doc(user: Optional[Dict]) -> Dict[str, List[str]]:
+    user = user or dict()
+    return {field: user.get(field, []) for field in SUBSCRIPTION_FIELDS}
 
 
-async def add_developer(cid: int, developer: str):
-    devs = await get_developers(cid)
-    if developer in devs:
-        raise pymongo.errors.DuplicateKeyError(f"{developer} is already in list")
-    user = {"cid": cid}
-    query = {"$push": {"developers": developer}}
+async def add_subscription(cid: int, field: str, value: str) -> Dict[str, List[str]]:
+    user = {"cid": cid, field: {"$ne": value}}
+    query = {"$addToSet": {field: value}, "$set": {"updated": datetime.now()}}
 
-    result: UpdateResult = await users_coll.update_one(user, query)
-    return result.modified_count
+    result = await users_coll.find_one_and_update(
+        user, query, projection=SUBSCRIPTION_FIELDS, return_document=ReturnDocument.AFTER
+    )
+    if result:
+        return get_subscriptions_from_doc(result)
+    # Nothing updated: either the subscription is already there or no such user
+    subscriptions = await get_subscriptions(cid)
+    if value in subscriptions[field]:
+        raise pymongo.errors.DuplicateKeyError(f"{value} is already in list")
+    return subscriptions
 
 
-async def del_developer(cid: int, developer: str):
+async def del_subscription(cid: int, field: str, value: str) -> Dict[str, List[str]]:
     user = {"cid": cid}
-    query = {"$pull": {"developers": developer}}
+    query = {"$pull": {field: value}, "$set": {"updated": datetime.now()}}
 
-    result: UpdateResult = await users_coll.update_one(user, query)
-    return result.modified_count
+    result = await users_coll.find_one_and_update(
+        user, query, projection=SUBSCRIPTION_FIELDS, return_document=ReturnDocument.AFTER
+    )
+    return get_subscriptions_from_doc(result)
 
 
-async def get_developers(cid: int):
+async def get_subscriptions(cid: int) -> Dict[str, List[str]]:
     user = {"cid": cid}
-    projection = {"developers": 1}
 
-    result = await users_coll.find_one(user, projection=projection)
-    return result["developers"] if result else list()
+    result = await users_coll.find_one(user, projection=SUBSCRIPTION_FIELDS)
+    return get_subscriptions_from_doc(result)
 
 
 async def get_user_last_developer(cid: int):
@@ -148,9 +511,192 @@ async def insert_task(task: Dict):
     return result.inserted_id
 
 
-async def get_rsearch_task():
-    task = await queue_coll.find_one_and_delete(
-        {'type': 'rsearch'}, sort=[('_id', pymongo.ASCENDING)]
+def get_claimable_tasks_query(task_type: str, max_attempts: int) -> Dict:
+    now = datetime.now()
+    query = {
+        "type": task_type,
+        "$or": [{"lease_until": None}, {"lease_until": {"$lt": now}}],
+        "attempts": {"$not": {"$gte": max_attempts}},
+    }
+
+    return query
+
+
+async def claim_rsearch_task(lease_secs: int, max_attempts: int):
+    # The task stays in the queue until completed, an expired lease means the
+    # agent died and another one can claim the task
+    query = get_claimable_tasks_query("rsearch", max_attempts)
+    update = {
+        "$set": {"lease_until": datetime.now() + timedelta(seconds=lease_secs)},
+        "$inc": {"attempts": 1},
+    }
+    task = await queue_coll.find_one_and_update(
+        query, update, sort=[("_id", pymongo.ASCENDING)], return_document=ReturnDocument.AFTER
     )
 
     return task
+
+
+async def complete_task(task_id: ObjectId):
+    result = await queue_coll.delete_one({"_id": task_id})
+    return result.deleted_count
+
+
+async def delete_exhausted_rsearch_tasks(max_attempts: int) -> int:
+    # Tasks whose last attempt died with its agent, the lease has expired
+    query = {
+        "type": "rsearch",
+        "attempts": {"$gte": max_attempts},
+        "lease_until": {"$lt": datetime.now()},
+    }
+    result = await queue_coll.delete_many(query)
+    return result.deleted_count
+
+
+async def count_rsearch_tasks(max_attempts: int) -> int:
+    query = get_claimable_tasks_query("rsearch", max_attempts)
+    return await queue_coll.count_documents(query)
+
+
+def watch_new_tasks():
+    pipeline = [{"$match": {"operationType": "insert"}}]
+    stream = queue_coll.watch(pipeline)
+
+    return stream
+
+
+def get_page_fingerprints():
+    cursor = pages_coll.find({})
+
+    return cursor
+
+
+async def save_page_fingerprint(url: str, fingerprint: Dict[str, str]):
+    page = {"url": url}
+    query = {"$set": fingerprint}
+
+    result: UpdateResult = await pages_coll.update_one(page, query, upsert=True)
+    return result.modified_count
+
+
+async def is_replica_set() -> bool:
+    result = await client.admin.command("isMaster")
+    return "setName" in result
+
+
+async def get_resume_token(stream: str):
+    result = await state_coll.find_one({"_id": stream})
+    return result["token"] if result else None
+
+
+async def save_resume_token(stream: str, token: Dict):
+    state = {"_id": stream}
+    query = {"$set": {"token": token}}
+
+    result: UpdateResult = await state_coll.update_one(state, query, upsert=True)
+    return result.modified_count
+
+
+def get_delivery_key(cid: int, app_id: ObjectId, event: Optional[str] = None) -> str:
+    key = f"{cid}:{app_id}"
+    return f"{key}:{event}" if event else key
+
+
+async def create_deliveries(deliveries: List[Dict]) -> List[str]:
+    created = datetime.now()
+    records = [
+        dict(
+            delivery,
+            _id=get_delivery_key(delivery["cid"], delivery["app_id"], delivery.get("event")),
+            status=DELIVERY_PENDING,
+            created=created,
+        )
+        for delivery in deliveries
+    ]
+    if not records:
+        return []
+
+    return await insert_many_skip_duplicates(outbox_coll, records)
+
+
+def get_claimable_deliveries_query(now: datetime) -> Dict:
+    # Pending deliveries and the ones claimed by a sender that didn't finish in time
+    return {"$or": [
+        {"status": DELIVERY_PENDING},
+        {"status": DELIVERY_SENDING, "claimed_until": {"$lt": now}},
+    ]}
+
+
+def get_pending_deliveries(shards: Optional[List[int]] = None, shard_count: int = 1):
+    query = get_claimable_deliveries_query(datetime.now())
+    shard_query = get_shard_query("cid", shards, shard_count)
+    if shard_query:
+        query = {"$and": [query, shard_query]}
+    cursor = outbox_coll.find(query).sort([("created", pymongo.ASCENDING)])
+
+    return cursor
+
+
+async def claim_deliveries(keys: List[str], claim: str, claim_secs: float) -> List[Dict]:
+    # Only the deliveries returned are claimed by this caller, others were
+    # taken by another sender in between
+    now = datetime.now()
+    query = {"_id": {"$in": keys}}
+    query.update(get_claimable_deliveries_query(now))
+    update = {"$set": {
+        "status": DELIVERY_SENDING,
+        "claim": claim,
+        "claimed_until": now + timedelta(seconds=claim_secs),
+    }}
+    await outbox_coll.update_many(query, update)
+
+    return await outbox_coll.find({"_id": {"$in": keys}, "claim": claim}).to_list(None)
+
+
+async def ack_deliveries(keys: List[str], claim: str, status: str = DELIVERY_SENT):
+    # Deliveries re-claimed by another sender after this claim expired are left to it
+    deliveries = {"_id": {"$in": keys}, "claim": claim}
+    query = {"$set": {"status": status}}
+
+    result: UpdateResult = await outbox_coll.update_many(deliveries, query)
+    return result.modified_count
+
+
+async def retry_deliveries(keys: List[str], claim: str, max_attempts: int):
+    # Deliveries that failed on a transient error go back to pending, the ones
+    # out of attempts are failed for good
+    deliveries = {"_id": {"$in": keys}, "claim": claim, "status": DELIVERY_SENDING}
+    exhausted = dict(deliveries, attempts={"$gte": max_attempts - 1})
+    failed: UpdateResult = await outbox_coll.update_many(
+        exhausted, {"$set": {"status": DELIVERY_FAILED}, "$inc": {"attempts": 1}}
+    )
+    query = {"$set": {"status": DELIVERY_PENDING}, "$inc": {"attempts": 1}}
+
+    result: UpdateResult = await outbox_coll.update_many(deliveries, query)
+    return failed.modified_count + result.modified_count
+
+
+async def claim_lease(name: str, owner: str, lease_secs: float) -> bool:
+    # Takes a free or expired lease or renews an own one
+    now = datetime.now()
+    lease = {
+        "_id": name,
+        "$or": [{"owner": owner}, {"lease_until": {"$lt": now}}],
+    }
+    query = {"$set": {"owner": owner, "lease_until": now + timedelta(seconds=lease_secs)}}
+    try:
+        await leases_coll.update_one(lease, query, upsert=True)
+    except pymongo.errors.DuplicateKeyError:
+        # Lease exists and is held by someone else
+        return False
+    return True
+
+
+async def release_lease(name: str, owner: str):
+    result = await leases_coll.delete_one({"_id": name, "owner": owner})
+    return result.deleted_count
+
+
+async def get_lease_owners(prefix: str) -> Set[str]:
+    query = {"_id": {"$regex": "^" + re.escape(prefix)}, "lease_until": {"$gte": datetime.now()}}
+    return set(await leases_coll.distinct("owner", query))
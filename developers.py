@@ -0,0 +1,76 @@
+import difflib
+import time
+from collections import Counter, defaultdict
+from typing import Dict, Iterable, List, Set
+
+NGRAM_SIZE = 3
+SUGGESTIONS_LIMIT = 3
+SUGGESTION_MIN_SCORE = 0.6
+
+
+def normalize_developer(dev: str) -> str:
+    # Same key is used for app authors at ingestion and for subscriptions
+    return " ".join(dev.lower().split())
+
+
+def get_ngrams(key: str) -> Set[str]:
+    padded = f" {key} "
+    if len(padded) <= NGRAM_SIZE:
+        return {padded}
+    return {padded[i:i + NGRAM_SIZE] for i in range(len(padded) - NGRAM_SIZE + 1)}
+
+
+class DeveloperIndex:
+    # In-memory n-gram index of known author keys for typo-tolerant lookups
+
+    def __init__(self, ttl_secs: float = 0):
+        self.ttl_secs = ttl_secs
+        self.updated = None
+        self.keys: Set[str] = set()
+        self.ngrams: Dict[str, Set[str]] = defaultdict(set)
+
+    def is_stale(self) -> bool:
+        return self.updated is None or time.monotonic() - self.updated > self.ttl_secs
+
+    def rebuild(self, keys: Iterable[str]):
+        self.keys = set()
+        self.ngrams = defaultdict(set)
+        self.add(keys)
+        self.updated = time.monotonic()
+
+    def add(self, keys: Iterable[str]):
+        for key in keys:
+            if key in self.keys:
+                continue
+            self.keys.add(key)
+            for ngram in get_ngrams(key):
+                self.ngrams[ngram].add(key)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.keys
+
+    def suggest(self, query: str, limit: int = SUGGESTIONS_LIMIT) -> List[str]:
+        query = normalize_developer(query)
+        query_ngrams = get_ngrams(query)
+        shared = Counter()
+        for ngram in query_ngrams:
+            shared.update(self.ngrams.get(ngram, ()))
+
+        scored = list()
+        for key, count in shared.items():
+            if key.startswith(query):
+                score = 1.0
+            else:
+                # Dice coefficient on n-grams, refined by edit similarity to
+                # the whole key and to its prefix for mistyped prefixes
+                dice = 2 * count / (len(query_ngrams) + len(get_ngrams(key)))
+                score = max(
+                    dice,
+                    difflib.SequenceMatcher(None, query, key).ratio(),
+                    difflib.SequenceMatcher(None, query, key[:len(query)]).ratio(),
+                )
+            if score >= SUGGESTION_MIN_SCORE:
+                scored.append((-score, key))
+        scored.sort()
+
+        return [key for _, key in scored[:limit]]
@@ -0,0 +1,183 @@
+import logging
+import logging.handlers
+import queue
+import sys
+import time
+from aiohttp import web
+from contextlib import contextmanager
+from typing import Dict, Optional, Sequence, Tuple
+
+LOG_FORMAT = "%(asctime)s [%(levelname)-9s] %(message)s"
+LOG_DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+METRICS_PREFIX = "storeglide_"
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+log_listener: Optional[logging.handlers.QueueListener] = None
+
+
+def setup_logging(level=logging.INFO):
+    # Records are formatted and written to stdout by a listener thread,
+    # the event loop only puts them into a queue
+    global log_listener
+    if log_listener is not None:
+        return
+    log_queue = queue.SimpleQueue()
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(logging.Formatter(LOG_FORMAT, LOG_DATE_FORMAT))
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    log_listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    log_listener.start()
+
+
+def stop_logging():
+    global log_listener
+    if log_listener is not None:
+        log_listener.stop()
+        log_listener = None
+
+
+def get_output_log(name: str):
+    logger = logging.getLogger(name)
+
+    def output_log(message, level="INFO"):
+        logger.log(logging.getLevelName(level.upper()), message)
+
+    return output_log
+
+
+def get_label_key(labels: Dict[str, str]) -> LabelKey:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def format_labels(key: LabelKey, extra: LabelKey = ()) -> str:
+    pairs = key + extra
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+
+class Metric:
+    type = ""
+
+    def __init__(self, name: str, documentation: str):
+        self.name = METRICS_PREFIX + name
+        self.documentation = documentation
+        registry[self.name] = self
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        lines += self.render_samples()
+        return "\n".join(lines)
+
+    def render_samples(self):
+        return []
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str):
+        super().__init__(name, documentation)
+        self.values: Dict[LabelKey, float] = dict()
+
+    def inc(self, amount: float = 1, **labels):
+        key = get_label_key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def render_samples(self):
+        return [f"{self.name}{format_labels(key)} {value}" for key, value in self.values.items()]
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def set(self, value: float, **labels):
+        self.values[get_label_key(labels)] = value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation)
+        self.buckets = tuple(buckets)
+        self.counts: Dict[LabelKey, list] = dict()
+        self.sums: Dict[LabelKey, float] = dict()
+
+    def observe(self, value: float, **labels):
+        key = get_label_key(labels)
+        counts = self.counts.setdefault(key, [0] * (len(self.buckets) + 1))
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+                break
+        else:
+            counts[-1] += 1
+        self.sums[key] = self.sums.get(key, 0) + value
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def render_samples(self):
+        lines = list()
+        for key, counts in self.counts.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(float(bound))
+                lines.append(f"{self.name}_bucket{format_labels(key, (('le', le),))} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(key)} {self.sums[key]}")
+            lines.append(f"{self.name}_count{format_labels(key)} {cumulative}")
+        return lines
+
+
+registry: Dict[str, Metric] = dict()
+
+FETCH_SECONDS = Histogram("fetch_seconds", "Storeglide page download time")
+PARSE_SECONDS = Histogram("parse_seconds", "Storeglide page parsing time")
+INSERT_SECONDS = Histogram("insert_seconds", "Apps batch insert time")
+SUBSCRIBER_LOOKUP_SECONDS = Histogram("subscriber_lookup_seconds", "Subscribers lookup time for a batch of apps")
+SEND_SECONDS = Histogram("send_seconds", "Telegram message send time including rate limit waits")
+QUEUE_WAIT_SECONDS = Histogram("queue_wait_seconds", "Time from task creation to its claim")
+
+NEW_APPS = Counter("new_apps_total", "Apps inserted into storage")
+UPDATED_APPS = Counter("updated_apps_total", "Stored apps changed since the previous crawl")
+ARCHIVED_APPS = Counter("archived_apps_total", "Apps rolled into the archive before expiring")
+DUPLICATE_APPS = Counter("duplicate_apps_total", "Crawled apps that were already stored unchanged")
+SENDS = Counter("sends_total", "Telegram messages sent")
+TELEGRAM_ERRORS = Counter("telegram_errors_total", "Telegram API errors by type")
+SEARCH_CACHE_REQUESTS = Counter("search_cache_requests_total", "Developer searches by cache result")
+PROXY_REQUESTS = Counter("proxy_requests_total", "Requests through a proxy by result")
+
+QUEUE_DEPTH = Gauge("queue_depth", "Claimable tasks in the queue")
+PENDING_NOTIFICATIONS = Gauge("pending_notifications", "Pending deliveries in the outbox")
+PROXY_LATENCY_SECONDS = Gauge("proxy_latency_seconds", "Smoothed request latency of a proxy")
+PROXY_HEALTHY = Gauge("proxy_healthy", "1 while the proxy is in rotation, 0 while ejected")
+
+
+def render_metrics() -> str:
+    return "\n".join(metric.render() for metric in registry.values()) + "\n"
+
+
+async def handle_metrics(request: web.Request) -> web.Response:
+    return web.Response(text=render_metrics(), content_type="text/plain")
+
+
+async def start_metrics_server(port: int, host: str = "0.0.0.0") -> web.AppRunner:
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    get_output_log(__name__)(f"Serving metrics on {host}:{port}/metrics")
+    return runner
@@ -0,0 +1,162 @@
+from collections import Counter, defaultdict, deque
+from typing import Dict, Iterable, List, Optional, Set
+
+from developers import normalize_developer
+from parsing import split_countries
+
+# Subscription kinds, stored as lists of the same name in the user document.
+# Authors, prefixes and keywords select apps, countries only narrow them down.
+AUTHORS = "developers"
+AUTHOR_PREFIXES = "author_prefixes"
+KEYWORDS = "keywords"
+COUNTRIES = "countries"
+SUBSCRIPTION_FIELDS = (AUTHORS, AUTHOR_PREFIXES, KEYWORDS, COUNTRIES)
+
+
+def normalize_subscription(field: str, value: str) -> str:
+    if field == COUNTRIES:
+        return value.strip().upper()
+    return normalize_developer(value)
+
+
+class AhoCorasick:
+    # Finds all patterns occurring in a text as whole words in one pass over
+    # the text
+
+    def __init__(self, patterns: Iterable[str]):
+        self.goto: List[Dict[str, int]] = [dict()]
+        self.fail: List[int] = [0]
+        self.output: List[Set[str]] = [set()]
+        for pattern in patterns:
+            self._add(pattern)
+        self._link()
+
+    def _add(self, pattern: str):
+        state = 0
+        for char in pattern:
+            next_state = self.goto[state].get(char)
+            if next_state is None:
+                next_state = len(self.goto)
+                self.goto[state][char] = next_state
+                self.goto.append(dict())
+                self.fail.append(0)
+                self.output.append(set())
+            state = next_state
+        self.output[state].add(pattern)
+
+    def _link(self):
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fail = self.fail[state]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[next_state] = self.goto[fail].get(char, 0)
+                self.output[next_state] |= self.output[self.fail[next_state]]
+
+    def find(self, text: str) -> Set[str]:
+        found = set()
+        state = 0
+        for end, char in enumerate(text, 1):
+            while state and char not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(char, 0)
+            if not self.output[state] or (end < len(text) and text[end].isalnum()):
+                continue
+            for pattern in self.output[state]:
+                # "art" is not found in "smart party"
+                start = end - len(pattern)
+                if start == 0 or not text[start - 1].isalnum():
+                    found.add(pattern)
+        return found
+
+
+class SubscriptionMatcher:
+    # In-memory index of all active subscriptions. Users are replaced one by
+    # one, only a changed keyword set rebuilds the automaton, on next match.
+
+    def __init__(self):
+        self.users: Dict[int, Dict[str, List[str]]] = dict()
+        self.by_author: Dict[str, Set[int]] = defaultdict(set)
+        self.by_prefix: Dict[str, Set[int]] = defaultdict(set)
+        self.prefix_lengths: Counter = Counter()
+        self.by_keyword: Dict[str, Set[int]] = defaultdict(set)
+        self.countries: Dict[int, Set[str]] = dict()
+        self.automaton: Optional[AhoCorasick] = None
+
+    def __len__(self) -> int:
+        return len(self.users)
+
+    def update_user(self, cid: int, subscriptions: Optional[Dict[str, List[str]]]):
+        # None or empty subscriptions remove the user
+        self.remove_user(cid)
+        if not subscriptions:
+            return
+        subscriptions = {field: list(subscriptions.get(field) or ()) for field in SUBSCRIPTION_FIELDS}
+        self.users[cid] = subscriptions
+        for author in subscriptions[AUTHORS]:
+            self.by_author[author].add(cid)
+        for prefix in subscriptions[AUTHOR_PREFIXES]:
+            if not self.by_prefix[prefix]:
+                self.prefix_lengths[len(prefix)] += 1
+            self.by_prefix[prefix].add(cid)
+        for keyword in subscriptions[KEYWORDS]:
+            if not self.by_keyword[keyword]:
+                self.automaton = None
+            self.by_keyword[keyword].add(cid)
+        if subscriptions[COUNTRIES]:
+            self.countries[cid] = set(subscriptions[COUNTRIES])
+
+    def remove_user(self, cid: int):
+        subscriptions = self.users.pop(cid, None)
+        if subscriptions is None:
+            return
+        for author in subscriptions[AUTHORS]:
+            self._discard(self.by_author, author, cid)
+        for prefix in subscriptions[AUTHOR_PREFIXES]:
+            if self._discard(self.by_prefix, prefix, cid):
+                self.prefix_lengths[len(prefix)] -= 1
+                if not self.prefix_lengths[len(prefix)]:
+                    del self.prefix_lengths[len(prefix)]
+        for keyword in subscriptions[KEYWORDS]:
+            if self._discard(self.by_keyword, keyword, cid):
+                self.automaton = None
+        self.countries.pop(cid, None)
+
+    @staticmethod
+    def _discard(index: Dict[str, Set[int]], key: str, cid: int) -> bool:
+        # True when the key has no subscribers left
+        cids = index.get(key)
+        if cids is None:
+            return False
+        cids.discard(cid)
+        if cids:
+            return False
+        del index[key]
+        return True
+
+    def match(self, apps: Iterable[Dict]) -> List[Set[int]]:
+        # Subscribed cids for every app, in the order of apps
+        if self.automaton is None:
+            self.automaton = AhoCorasick(self.by_keyword)
+        matches = list()
+        for app in apps:
+            author_key = app.get("author_key") or normalize_developer(app["author"])
+            cids = set(self.by_author.get(author_key, ()))
+            for length in self.prefix_lengths:
+                cids.update(self.by_prefix.get(author_key[:length], ()))
+            if self.by_keyword:
+                for keyword in self.automaton.find(normalize_developer(app["name"])):
+                    cids.update(self.by_keyword[keyword])
+            if self.countries and cids:
+                # Added countries of a changed app, all countries of a new one
+                countries = app.get("new_countries") or split_countries(app["countries"])
+                countries = {country.upper() for country in countries}
+                cids = {
+                    cid for cid in cids
+                    if cid not in self.countries or self.countries[cid] & countries
+                }
+            matches.append(cids)
+        return matches
@@ -0,0 +1,580 @@
+import asyncio
+import uvloop
+import pymongo.errors
+from bson import ObjectId
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+from archive import filter_apps, get_bucket, merge_apps, pack_apps, unpack_apps
+from developers import normalize_developer
+from matching import SUBSCRIPTION_FIELDS
+from parsing import App, split_countries
+
+# In-memory storage with the same functions and semantics as database.py:
+# unique app links and user cids, TTL expiry of apps and outbox records,
+# developer lookups. Documents are copied in and out like with a real driver.
+# Change streams are not available, is_replica_set keeps callers on polling.
+
+DELIVERY_PENDING = "pending"
+DELIVERY_SENDING = "sending"
+DELIVERY_SENT = "sent"
+DELIVERY_FAILED = "failed"
+
+asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+loop = asyncio.get_event_loop()
+
+# Apps and outbox records are kept in insertion order, which is also the
+# creation order, so expired ones are always at the front
+apps: Dict[ObjectId, Dict] = dict()
+app_ids_by_link: Dict[str, ObjectId] = dict()
+app_ids_by_author_key: Dict[str, Dict[ObjectId, None]] = defaultdict(dict)
+not_notified_app_ids: Dict[ObjectId, None] = dict()
+users: Dict[int, Dict] = dict()
+tasks: Dict[ObjectId, Dict] = dict()
+page_fingerprints: Dict[str, Dict] = dict()
+resume_tokens: Dict[str, Dict] = dict()
+outbox: Dict[str, Dict] = dict()
+leases: Dict[str, Dict] = dict()
+author_versions: Dict[str, int] = dict()
+search_version = 0
+archive: Dict[Tuple[str, datetime], Dict] = dict()
+archived_until: Optional[datetime] = None
+
+app_expire_secs: Optional[int] = None
+
+
+class MemoryCursor:
+    def __init__(self, docs: Iterable[Dict]):
+        self._docs = [copy_doc(doc) for doc in docs]
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for doc in self._docs:
+            yield doc
+
+    async def to_list(self, length: Optional[int]):
+        return self._docs[:length] if length else list(self._docs)
+
+
+def copy_doc(doc: Dict, projection: Optional[Iterable[str]] = None) -> Dict:
+    keys = doc.keys() if projection is None else [k for k in projection if k in doc]
+    return {k: list(doc[k]) if isinstance(doc[k], list) else doc[k] for k in keys}
+
+
+def expire_docs():
+    if app_expire_secs is None:
+        return
+    deadline = datetime.now() - timedelta(seconds=app_expire_secs)
+    while apps:
+        app_id, app = next(iter(apps.items()))
+        if app["created"] >= deadline:
+            break
+        remove_app(app_id)
+    while outbox:
+        key, delivery = next(iter(outbox.items()))
+        if delivery["created"] >= deadline:
+            break
+        del outbox[key]
+
+
+def remove_app(app_id: ObjectId):
+    app = apps.pop(app_id)
+    del app_ids_by_link[app["link"]]
+    by_author = app_ids_by_author_key[app["author_key"]]
+    del by_author[app_id]
+    if not by_author:
+        del app_ids_by_author_key[app["author_key"]]
+    not_notified_app_ids.pop(app_id, None)
+
+
+async def create_indexes(expire_secs: int):
+    global app_expire_secs
+    app_expire_secs = expire_secs
+
+
+async def wait_ready(timeout_secs: float = 0):
+    pass
+
+
+def close():
+    pass
+
+
+def get_app_fields(app: App) -> Dict[str, str]:
+    fields = app._asdict()
+    fields.update(author_key=normalize_developer(app.author), content_hash=app.content_hash)
+    return fields
+
+
+def insert_app(app: App, created: datetime) -> ObjectId:
+    app_id = ObjectId()
+    fields = get_app_fields(app)
+    apps[app_id] = dict(fields, _id=app_id, created=created, notified=False)
+    app_ids_by_link[app.link] = app_id
+    app_ids_by_author_key[fields["author_key"]][app_id] = None
+    not_notified_app_ids[app_id] = None
+
+    return app_id
+
+
+def update_app(app: App, author_keys: Set[str]) -> bool:
+    app_id = app_ids_by_link[app.link]
+    doc = apps[app_id]
+    fields = get_app_fields(app)
+    if doc["content_hash"] == fields["content_hash"]:
+        return False
+
+    author_keys.update((doc["author_key"], fields["author_key"]))
+
+    old_countries = set(split_countries(doc["countries"]))
+    new_countries = [c for c in split_countries(app.countries) if c not in old_countries]
+    if fields["author_key"] != doc["author_key"]:
+        by_author = app_ids_by_author_key[doc["author_key"]]
+        del by_author[app_id]
+        if not by_author:
+            del app_ids_by_author_key[doc["author_key"]]
+        app_ids_by_author_key[fields["author_key"]][app_id] = None
+    doc.update(fields)
+    if new_countries:
+        doc.update(new_countries=new_countries, notified=False)
+        doc.pop("notified_shards", None)
+        not_notified_app_ids[app_id] = None
+    return True
+
+
+async def create_apps(apps: List[App]) -> Dict[str, Any]:
+    expire_docs()
+    created = datetime.now()
+    inserted_ids = list()
+    author_keys = set()
+    updated = 0
+    seen = set()
+    for app in apps:
+        if app.link in seen:
+            continue
+        seen.add(app.link)
+        if app.link in app_ids_by_link:
+            updated += update_app(app, author_keys)
+        else:
+            inserted_ids.append(insert_app(app, created))
+            author_keys.add(normalize_developer(app.author))
+
+    return {
+        "inserted": len(inserted_ids),
+        "updated": updated,
+        "skipped": len(apps) - len(inserted_ids) - updated,
+        "inserted_ids": inserted_ids,
+        "author_keys": list(author_keys),
+    }
+
+
+def in_shards(cid: int, shards: Optional[List[int]], shard_count: int) -> bool:
+    if not shards or shard_count <= 1:
+        return True
+    return abs(cid) % shard_count in shards
+
+
+async def mark_apps_notified(app_ids: List[ObjectId], shards: Optional[List[int]] = None,
+                             shard_count: int = 1):
+    modified = 0
+    for app_id in app_ids:
+        app = apps.get(app_id)
+        if app is None:
+            continue
+        if shard_count > 1:
+            notified_shards = app.setdefault("notified_shards", [])
+            notified_shards.extend(s for s in shards if s not in notified_shards)
+            if len(set(notified_shards)) < shard_count:
+                continue
+        app.pop("new_countries", None)
+        if not app["notified"]:
+            app["notified"] = True
+            modified += 1
+        not_notified_app_ids.pop(app_id, None)
+    return modified
+
+
+async def get_known_apps(links: List[str]) -> Dict[str, Dict]:
+    expire_docs()
+    projection = App._fields + ("_id", "author_key", "content_hash")
+    return {
+        link: copy_doc(apps[app_ids_by_link[link]], projection)
+        for link in links if link in app_ids_by_link
+    }
+
+
+def get_not_notified_apps(shards: Optional[List[int]] = None):
+    expire_docs()
+    found = (apps[app_id] for app_id in not_notified_app_ids)
+    if shards:
+        found = (app for app in found if not set(shards).issubset(app.get("notified_shards", ())))
+    return MemoryCursor(found)
+
+
+def find_apps_by_dev(dev_string: str, prefix: bool = False) -> List[Dict]:
+    expire_docs()
+    key = normalize_developer(dev_string.strip('"'))
+    if prefix:
+        keys = sorted(k for k in app_ids_by_author_key if k.startswith(key))
+    else:
+        keys = [key] if key in app_ids_by_author_key else []
+    found = list()
+    for k in keys:
+        # Newest first inside one author
+        found += reversed([apps[app_id] for app_id in app_ids_by_author_key[k]])
+
+    return found
+
+
+def search_apps_by_dev(dev_string: str, prefix: bool = False, skip: int = 0, limit: int = 0):
+    found = find_apps_by_dev(dev_string, prefix)
+    found = found[skip:skip + limit] if limit else found[skip:]
+
+    return MemoryCursor(found)
+
+
+async def count_apps_by_dev(dev_string: str, prefix: bool = False) -> int:
+    return len(find_apps_by_dev(dev_string, prefix))
+
+
+def search_latest_apps_by_dev(dev_string: str, prefix: bool = False, limit: int = 0):
+    found = sorted(find_apps_by_dev(dev_string, prefix), key=lambda app: app["created"], reverse=True)
+    found = found[:limit] if limit else found
+
+    return MemoryCursor(found)
+
+
+def get_expiring_apps(since: Optional[datetime], until: datetime):
+    expire_docs()
+    found = (
+        app for app in apps.values()
+        if app["created"] < until and (since is None or app["created"] >= since)
+    )
+    return MemoryCursor(found)
+
+
+async def archive_apps(apps: List[Dict], bucket_days: int) -> int:
+    by_bucket = defaultdict(list)
+    for app in apps:
+        by_bucket[(app["author_key"], get_bucket(app["created"], bucket_days))].append(app)
+    updated = datetime.now()
+    for (key, bucket), bucket_apps in by_bucket.items():
+        doc = archive.get((key, bucket))
+        merged = merge_apps(unpack_apps(doc["apps"]) if doc else [], bucket_apps)
+        archive[(key, bucket)] = {
+            "author_key": key,
+            "bucket": bucket,
+            "end": bucket + timedelta(days=bucket_days),
+            "count": len(merged),
+            "apps": pack_apps(merged),
+            "updated": updated,
+        }
+
+    return len(apps)
+
+
+async def search_archive(dev_string: str, since: datetime, until: datetime, prefix: bool = False,
+                         limit: int = 0) -> List[Dict]:
+    key = normalize_developer(dev_string.strip('"'))
+    docs = [
+        doc for doc in archive.values()
+        if (doc["author_key"].startswith(key) if prefix else doc["author_key"] == key)
+        and doc["end"] > since and doc["bucket"] < until
+    ]
+    docs.sort(key=lambda doc: doc["end"], reverse=True)
+
+    found = list()
+    for doc in docs:
+        if limit and len(found) >= limit and found[limit - 1]["created"] >= doc["end"]:
+            break
+        found += filter_apps(unpack_apps(doc["apps"]), since, until)
+        found.sort(key=lambda app: app["created"], reverse=True)
+    return found
+
+
+async def get_archived_until() -> Optional[datetime]:
+    return archived_until
+
+
+async def save_archived_until(until: datetime):
+    global archived_until
+    modified = archived_until != until
+    archived_until = until
+
+    return int(modified)
+
+
+async def bump_author_versions(author_keys: Iterable[str]) -> Optional[int]:
+    global search_version
+    author_keys = list(author_keys)
+    if not author_keys:
+        return None
+    search_version += 1
+    for key in author_keys:
+        author_versions[key] = search_version
+    return search_version
+
+
+async def get_search_version() -> int:
+    return search_version
+
+
+async def get_author_versions(since: int) -> Dict[str, int]:
+    return {key: version for key, version in author_versions.items() if version >= since}
+
+
+async def get_author_keys() -> List[str]:
+    expire_docs()
+    return list(app_ids_by_author_key)
+
+
+async def backfill_author_keys():
+    return 0
+
+
+async def backfill_developer_keys():
+    return 0
+
+
+async def create_user(cid: int):
+    if cid in users:
+        raise pymongo.errors.DuplicateKeyError(f"User {cid} already exists")
+    user_id = ObjectId()
+    users[cid] = {"_id": user_id, "cid": cid, "active": True, "developers": [], "updated": datetime.now()}
+
+    return user_id
+
+
+async def change_user_status(cid: int, active: bool):
+    user = users.get(cid)
+    if user is None or user["active"] == active:
+        return 0
+    user.update(active=active, updated=datetime.now())
+    return 1
+
+
+def get_updated_subscribers(since: Optional[datetime] = None, shards: Optional[List[int]] = None,
+                            shard_count: int = 1):
+    found = [
+        user for cid, user in sorted(users.items())
+        if (since is None or user["updated"] >= since) and in_shards(cid, shards, shard_count)
+    ]
+
+    return MemoryCursor(copy_doc(user, ("cid", "active") + SUBSCRIPTION_FIELDS) for user in found)
+
+
+def get_subscriptions_from_doc(user: Optional[Dict]) -> Dict[str, List[str]]:
+    user = user or dict()
+    return {field: list(user.get(field, [])) for field in SUBSCRIPTION_FIELDS}
+
+
+async def add_subscription(cid: int, field: str, value: str) -> Dict[str, List[str]]:
+    user = users.get(cid)
+    if user is None:
+        return get_subscriptions_from_doc(None)
+    values = user.setdefault(field, [])
+    if value in values:
+        raise pymongo.errors.DuplicateKeyError(f"{value} is already in list")
+    values.append(value)
+    user["updated"] = datetime.now()
+
+    return get_subscriptions_from_doc(user)
+
+
+async def del_subscription(cid: int, field: str, value: str) -> Dict[str, List[str]]:
+    user = users.get(cid)
+    if user is None:
+        return get_subscriptions_from_doc(None)
+    if value in user.get(field, []):
+        user[field] = [v for v in user[field] if v != value]
+    user["updated"] = datetime.now()
+
+    return get_subscriptions_from_doc(user)
+
+
+async def get_subscriptions(cid: int) -> Dict[str, List[str]]:
+    return get_subscriptions_from_doc(users.get(cid))
+
+
+async def get_user_last_developer(cid: int):
+    user = users.get(cid)
+    return user["developers"][-1:] if user else []
+
+
+async def insert_task(task: Dict):
+    task_id = ObjectId()
+    tasks[task_id] = dict(copy_doc(task), _id=task_id)
+    task["_id"] = task_id
+
+    return task_id
+
+
+def is_claimable(task: Dict, task_type: str, max_attempts: int, now: datetime) -> bool:
+    lease_until = task.get("lease_until")
+    return (
+        task.get("type") == task_type
+        and (lease_until is None or lease_until < now)
+        and task.get("attempts", 0) < max_attempts
+    )
+
+
+async def claim_rsearch_task(lease_secs: int, max_attempts: int):
+    now = datetime.now()
+    for task in tasks.values():
+        if is_claimable(task, "rsearch", max_attempts, now):
+            task["lease_until"] = now + timedelta(seconds=lease_secs)
+            task["attempts"] = task.get("attempts", 0) + 1
+            return copy_doc(task)
+
+    return None
+
+
+async def complete_task(task_id: ObjectId):
+    return 1 if tasks.pop(task_id, None) else 0
+
+
+async def delete_exhausted_rsearch_tasks(max_attempts: int) -> int:
+    now = datetime.now()
+    exhausted = [
+        task_id for task_id, task in tasks.items()
+        if task.get("type") == "rsearch"
+        and task.get("attempts", 0) >= max_attempts
+        and task.get("lease_until") is not None and task["lease_until"] < now
+    ]
+    for task_id in exhausted:
+        del tasks[task_id]
+    return len(exhausted)
+
+
+async def count_rsearch_tasks(max_attempts: int) -> int:
+    now = datetime.now()
+    return sum(is_claimable(task, "rsearch", max_attempts, now) for task in tasks.values())
+
+
+def get_page_fingerprints():
+    return MemoryCursor(page_fingerprints.values())
+
+
+async def save_page_fingerprint(url: str, fingerprint: Dict[str, str]):
+    page = page_fingerprints.setdefault(url, {"_id": ObjectId(), "url": url})
+    modified = any(page.get(k) != v for k, v in fingerprint.items())
+    page.update(fingerprint)
+
+    return int(modified)
+
+
+async def is_replica_set() -> bool:
+    # No change streams, callers stay on polling
+    return False
+
+
+async def get_resume_token(stream: str):
+    return resume_tokens.get(stream)
+
+
+async def save_resume_token(stream: str, token: Dict):
+    modified = resume_tokens.get(stream) != token
+    resume_tokens[stream] = token
+
+    return int(modified)
+
+
+def get_delivery_key(cid: int, app_id: ObjectId, event: Optional[str] = None) -> str:
+    key = f"{cid}:{app_id}"
+    return f"{key}:{event}" if event else key
+
+
+async def create_deliveries(deliveries: List[Dict]) -> List[str]:
+    expire_docs()
+    created = datetime.now()
+    inserted_keys = list()
+    for delivery in deliveries:
+        key = get_delivery_key(delivery["cid"], delivery["app_id"], delivery.get("event"))
+        if key in outbox:
+            continue
+        outbox[key] = dict(copy_doc(delivery), _id=key, status=DELIVERY_PENDING, created=created)
+        inserted_keys.append(key)
+
+    return inserted_keys
+
+
+def is_claimable_delivery(delivery: Dict, now: datetime) -> bool:
+    return delivery["status"] == DELIVERY_PENDING or (
+        delivery["status"] == DELIVERY_SENDING and delivery["claimed_until"] < now
+    )
+
+
+def get_pending_deliveries(shards: Optional[List[int]] = None, shard_count: int = 1):
+    expire_docs()
+    now = datetime.now()
+    return MemoryCursor(
+        d for d in outbox.values()
+        if is_claimable_delivery(d, now) and in_shards(d["cid"], shards, shard_count)
+    )
+
+
+async def claim_deliveries(keys: List[str], claim: str, claim_secs: float) -> List[Dict]:
+    now = datetime.now()
+    claimed = list()
+    for key in keys:
+        delivery = outbox.get(key)
+        if delivery is None or not is_claimable_delivery(delivery, now):
+            continue
+        delivery.update(
+            status=DELIVERY_SENDING, claim=claim, claimed_until=now + timedelta(seconds=claim_secs)
+        )
+        claimed.append(copy_doc(delivery))
+
+    return claimed
+
+
+async def ack_deliveries(keys: List[str], claim: str, status: str = DELIVERY_SENT):
+    modified = 0
+    for key in keys:
+        delivery = outbox.get(key)
+        if delivery is not None and delivery.get("claim") == claim and delivery["status"] != status:
+            delivery["status"] = status
+            modified += 1
+
+    return modified
+
+
+async def retry_deliveries(keys: List[str], claim: str, max_attempts: int):
+    retried = 0
+    for key in keys:
+        delivery = outbox.get(key)
+        if delivery is None or delivery.get("claim") != claim or delivery["status"] != DELIVERY_SENDING:
+            continue
+        delivery["attempts"] = delivery.get("attempts", 0) + 1
+        delivery["status"] = DELIVERY_FAILED if delivery["attempts"] >= max_attempts else DELIVERY_PENDING
+        retried += 1
+
+    return retried
+
+
+async def claim_lease(name: str, owner: str, lease_secs: float) -> bool:
+    now = datetime.now()
+    lease = leases.get(name)
+    if lease is not None and lease["owner"] != owner and lease["lease_until"] >= now:
+        return False
+    leases[name] = {"_id": name, "owner": owner, "lease_until": now + timedelta(seconds=lease_secs)}
+    return True
+
+
+async def release_lease(name: str, owner: str):
+    lease = leases.get(name)
+    if lease is None or lease["owner"] != owner:
+        return 0
+    del leases[name]
+    return 1
+
+
+async def get_lease_owners(prefix: str) -> Set[str]:
+    now = datetime.now()
+    return {
+        lease["owner"] for name, lease in leases.items()
+        if name.startswith(prefix) and lease["lease_until"] >= now
+    }
@@ -1,11 +1,24 @@
 import asyncio
+import os
+import pymongo.errors
 import signal
 import json
-from aiogram import Bot
-from datetime import datetime
-from time import sleep
+import uuid
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional, Set
 
-import database as db
+from storage import db
+from instrumentation import (
+    ARCHIVED_APPS, PENDING_NOTIFICATIONS, QUEUE_DEPTH, QUEUE_WAIT_SECONDS, SUBSCRIBER_LOOKUP_SECONDS,
+    get_output_log, setup_logging, start_metrics_server, stop_logging,
+)
+from profiling import install_profiling_handler
+from matching import SubscriptionMatcher
+from search_cache import search_cache
+from sender import SEND_FAILED, SEND_OK, SEND_RETRY, SendScheduler, build_digest_groups
+from sharding import ShardLeases
+from telegram import bot_pool
 
 ADMINS_FILE = "secrets/admins.json"
 with open(ADMINS_FILE) as admins_file:
@@ -14,84 +27,324 @@ with open(ADMINS_FILE) as admins_file:
 NOTIFY_ADMINS_TASK_NAME = "adm_notify"
 NOTIFY_ADMINS_TASK_TIMEOUT = 3
 
-SECRETS_FILE = "secrets/credentials.json"
-with open(SECRETS_FILE) as file:
-    secrets = json.load(file)
-
-
-PROXY_HOST = secrets["proxy_host"]
-PROXY_PORT = secrets["proxy_port"]
-PROXY_USER = secrets["proxy_user"]
-PROXY_PASS = secrets["proxy_pass"]
-PROXY_PROTO = "socks5"
-PROXY_URL = f"{PROXY_PROTO}://{PROXY_USER}:{PROXY_PASS}@{PROXY_HOST}:{PROXY_PORT}"
-
-API_TOKEN = secrets["api_token"]
 SLEEP_TIMER_SECS = 300
+METRICS_PORT = 9102
 APP_EXPIRE_SECS = 5 * 24 * 60 * 60
 
+# Change stream mode wakes the notifier on every app insert. It needs a replica
+# set and falls back to polling every SLEEP_TIMER_SECS on a standalone server.
+CHANGE_STREAM_MODE = True
+CHANGE_STREAM_NAME = "apps_inserts"
+CHANGE_STREAM_BATCH_SECS = 2
+CHANGE_STREAM_MAX_AWAIT_MS = 500
+
+NOTIFY_APPS_BATCH_SIZE = 200
+OUTBOX_ACK_BATCH_SIZE = 100
+# Deliveries are claimed per chunk before sending, a replica that took the
+# shard over can't send them again until the claim expires
+DELIVERY_CLAIM_SECS = 600
+# Deliveries failed on network errors go back to the outbox until this many
+# sends failed
+DELIVERY_MAX_ATTEMPTS = 5
+DELIVERY_LOST = "lost"
+
+# Agents are started on demand, up to one per queued task. The queue is watched
+# through a change stream, without a replica set it is checked every
+# RETROSPECTIVE_SEARCH_POLL_SECS with a read-only count.
 RETROSPECTIVE_SEARCH_AGENT_COUNT = 5
-RETROSPECTIVE_SEARCH_AGENT_SLEEP_TIMER = 0.3
+RETROSPECTIVE_SEARCH_POLL_SECS = 1
+RETROSPECTIVE_SEARCH_LEASE_SECS = 60
+RETROSPECTIVE_SEARCH_MAX_ATTEMPTS = 3
+
+# Users are split into shards by chat id, every running notifier replica takes
+# its share of them. Shards of a stopped replica move on when the lease expires.
+NOTIFIER_SHARD_COUNT = int(os.environ.get("NOTIFIER_SHARD_COUNT", 1))
+NOTIFIER_SHARD_LEASE_SECS = 30
 
-bot = Bot(token=API_TOKEN, proxy=PROXY_URL)
+# Apps are rolled into per-author buckets of ARCHIVE_BUCKET_DAYS days
+# ARCHIVE_LEAD_SECS before the TTL index removes them. One replica at a time
+# archives, changes to an app after it was archived are not archived.
+ARCHIVE_EVERY_SECS = 600
+ARCHIVE_LEAD_SECS = 6 * 60 * 60
+ARCHIVE_BUCKET_DAYS = int(os.environ.get("ARCHIVE_BUCKET_DAYS", 7))
+ARCHIVE_BATCH_SIZE = 500
+ARCHIVE_LEASE = "archiver"
+ARCHIVE_LEASE_SECS = ARCHIVE_EVERY_SECS * 2
 
+NEW_APP_MESSAGE = "New app {name} from {author} released for {countries}:\n{link}"
+NEW_COUNTRIES_MESSAGE = "App {name} from {author} is now also released for {new_countries}:\n{link}"
 
-def output_log(message, level="INFO"):
-    n = datetime.now()
-    ns = n.strftime("%Y-%m-%d %H:%M:%S")
-    print(f"{ns} " + f"[{level.upper()}".ljust(10, " ") + f"] {message}")
+# Subscriptions are matched in memory, every pass fetches only the users
+# changed since the previous one. The overlap covers clock skew between hosts.
+SUBSCRIPTIONS_SYNC_OVERLAP_SECS = 60
+
+# Merge several new apps for one user into a single message
+DIGEST_MODE = True
+
+scheduler = SendScheduler(bot_pool)
+matcher = SubscriptionMatcher()
+matcher_shards: Optional[List[int]] = None
+matcher_synced: Optional[datetime] = None
+shard_leases = ShardLeases(NOTIFIER_SHARD_COUNT, NOTIFIER_SHARD_LEASE_SECS)
+# Created on first use, aiogram replaces the event loop policy on import
+notify_lock: Optional[asyncio.Lock] = None
+# Notification passes started by lease renewal, referenced until done
+notify_tasks: Set[asyncio.Task] = set()
+
+
+output_log = get_output_log("notifier")
 
 
 async def notify_admins(text: str):
-    n_tasks = [
-        asyncio.create_task(bot.send_message(cid, text)) for cid in admins["cids"]
+    await scheduler.send_many((cid, text) for cid in admins["cids"])
+
+
+def get_owned_shards() -> Optional[List[int]]:
+    if NOTIFIER_SHARD_COUNT <= 1:
+        return None
+    return shard_leases.shards
+
+
+def get_app_message(app: Dict) -> str:
+    if app.get("new_countries"):
+        return NEW_COUNTRIES_MESSAGE.format(**dict(app, new_countries=", ".join(app["new_countries"])))
+    return NEW_APP_MESSAGE.format(**app)
+
+
+async def sync_matcher(shards: Optional[List[int]] = None) -> SubscriptionMatcher:
+    global matcher, matcher_shards, matcher_synced
+    if matcher_synced is None or shards != matcher_shards:
+        # First sync or shards moved, load subscriptions of all owned users
+        matcher = SubscriptionMatcher()
+        matcher_shards = shards
+        since = None
+    else:
+        since = matcher_synced - timedelta(seconds=SUBSCRIPTIONS_SYNC_OVERLAP_SECS)
+
+    synced = datetime.now()
+    updated = 0
+    async for user in db.get_updated_subscribers(since, shards, NOTIFIER_SHARD_COUNT):
+        matcher.update_user(user["cid"], user if user["active"] else None)
+        updated += 1
+    matcher_synced = synced
+    if updated:
+        output_log(f"Synced {updated} users, {len(matcher)} users have subscriptions")
+    return matcher
+
+
+async def send_user_notifications(cid: int, texts: List[str]) -> bool:
+    if DIGEST_MODE:
+        results = await scheduler.send_digest(cid, texts)
+    else:
+        results = await scheduler.send_many((cid, text) for text in texts)
+    return all(results)
+
+
+async def send_notifications(messages: Dict[int, List[str]]) -> Dict[int, bool]:
+    cids = list(messages)
+    tasks = [
+        asyncio.create_task(send_user_notifications(cid, messages[cid])) for cid in cids
     ]
-    await asyncio.gather(*n_tasks)
+    results = await asyncio.gather(*tasks)
+
+    return dict(zip(cids, results))
+
+
+async def claim_deliveries(keys: List[str]) -> Dict[int, List[Dict]]:
+    # Deliveries this replica may send, by cid
+    chunk = defaultdict(list)
+    if not keys:
+        return chunk
+    claim = f"{shard_leases.owner}:{uuid.uuid4().hex}"
+    for delivery in await db.claim_deliveries(keys, claim, DELIVERY_CLAIM_SECS):
+        chunk[delivery["cid"]].append(delivery)
+    return chunk
+
+
+async def send_deliveries(cid: int, deliveries: List[Dict]) -> Counter:
+    # Every message is acknowledged as soon as it is sent, with the deliveries
+    # it holds, so one failed part of a digest doesn't fail the others
+    texts = [delivery["text"] for delivery in deliveries]
+    if DIGEST_MODE:
+        messages = build_digest_groups(texts)
+    else:
+        messages = [(text, [i]) for i, text in enumerate(texts)]
+
+    async def send_message(text: str, indexes: List[int]) -> Counter:
+        keys = [deliveries[i]["_id"] for i in indexes]
+        claim = deliveries[indexes[0]]["claim"]
+        status = await scheduler.send_status(cid, text)
+        if status == SEND_OK:
+            acked = await db.ack_deliveries(keys, claim, db.DELIVERY_SENT)
+        elif status == SEND_RETRY:
+            acked = await db.retry_deliveries(keys, claim, DELIVERY_MAX_ATTEMPTS)
+        else:
+            acked = await db.ack_deliveries(keys, claim, db.DELIVERY_FAILED)
+        # Claim expired during a slow send and another replica took the deliveries
+        return Counter({status: acked, DELIVERY_LOST: len(keys) - acked})
+
+    results = await asyncio.gather(*(send_message(text, indexes) for text, indexes in messages))
+    return sum(results, Counter())
+
+
+async def deliver_outbox(shards: Optional[List[int]] = None):
+    pending = defaultdict(list)
+    async for delivery in db.get_pending_deliveries(shards, NOTIFIER_SHARD_COUNT):
+        pending[delivery["cid"]].append(delivery)
+    pending_count = sum(len(deliveries) for deliveries in pending.values())
+    PENDING_NOTIFICATIONS.set(pending_count)
+    if not pending:
+        output_log("No notifications should be done")
+        return
+
+    output_log(f"Sending notifications to {len(pending)} users")
+    cids = list(pending)
+    for i in range(0, len(cids), OUTBOX_ACK_BATCH_SIZE):
+        chunk_cids = cids[i:i + OUTBOX_ACK_BATCH_SIZE]
+        chunk_count = sum(len(pending[cid]) for cid in chunk_cids)
+        owned = get_owned_shards()
+        if owned is not None:
+            # Shards may have moved to another replica since the outbox was read
+            chunk_cids = [cid for cid in chunk_cids if abs(cid) % NOTIFIER_SHARD_COUNT in owned]
+        chunk = await claim_deliveries([d["_id"] for cid in chunk_cids for d in pending[cid]])
+        tasks = [asyncio.create_task(send_deliveries(cid, deliveries)) for cid, deliveries in chunk.items()]
+        results = sum(await asyncio.gather(*tasks), Counter())
+        pending_count -= chunk_count
+        PENDING_NOTIFICATIONS.set(pending_count)
+        skipped = chunk_count - sum(results.values())
+        output_log(
+            f"Acknowledged {results[SEND_OK]} sent and {results[SEND_FAILED]} failed deliveries, "
+            f"{results[SEND_RETRY]} left to retry, skipped {skipped} taken by another replica"
+        )
+        if results[DELIVERY_LOST]:
+            output_log(
+                f"Lost {results[DELIVERY_LOST]} deliveries to another replica, "
+                f"their claims expired while sending", "WARNING"
+            )
+    output_log("Notifications done")
 
 
 async def notify_users():
+    global notify_lock
+    if notify_lock is None:
+        notify_lock = asyncio.Lock()
+    async with notify_lock:
+        shards = get_owned_shards()
+        if shards == []:
+            output_log("No shards owned, skipping notification process")
+            return
+        await notify_shards(shards)
+
+
+async def notify_shards(shards: Optional[List[int]]):
     output_log("Starting notification process")
-    apps = db.get_not_notified_apps()
-    tasks = list()
+    apps = await db.get_not_notified_apps(shards).to_list(None)
+    deliveries = list()
     app_ids = list()
-    async for app in apps:
-        output_log(f"New app {app['name']} found")
-        users = db.get_users_by_developer(app["author"].lower())
-        text = "New app {name} from {author} released for {countries}:\n{link}".format(**app)
-        users_to_notify = 0
-        async for u in users:
-            if u['active']:
-                tasks.append(
-                    asyncio.create_task(bot.send_message(u["cid"], text))
-                )
-                users_to_notify += 1
-        output_log(f"Found {users_to_notify} users for this app")
-        app_ids.append(app['_id'])
-
-    if tasks:
-        output_log("Sending notifications")
-        await asyncio.gather(*tasks)
-        output_log("Notifications done")
-    else:
-        output_log("No notifications should be done")
+    subscription_matcher = await sync_matcher(shards)
+    for i in range(0, len(apps), NOTIFY_APPS_BATCH_SIZE):
+        batch = apps[i:i + NOTIFY_APPS_BATCH_SIZE]
+        with SUBSCRIBER_LOOKUP_SECONDS.time():
+            subscribers = subscription_matcher.match(batch)
+        for app, cids in zip(batch, subscribers):
+            if app.get("new_countries"):
+                output_log(f"App {app['name']} released for new countries {app['new_countries']}")
+                # Content hash tells this change apart from the first release and other changes
+                event = app["content_hash"]
+            else:
+                output_log(f"New app {app['name']} found")
+                event = None
+            text = get_app_message(app)
+            for cid in cids:
+                deliveries.append({"cid": cid, "app_id": app["_id"], "event": event, "text": text})
+            output_log(f"Found {len(cids)} users for this app")
+            app_ids.append(app['_id'])
+
+    # Outbox goes first: a crash before marking apps only recreates the same
+    # records, a crash during sending resumes from pending records
+    if deliveries:
+        output_log("Writing deliveries to outbox")
+        await db.create_deliveries(deliveries)
     if app_ids:
         output_log("Marking apps as notified")
-        await asyncio.gather(*[asyncio.create_task(db.change_app_notification_status(app_id, True)) for app_id in app_ids])
+        await db.mark_apps_notified(app_ids, shards, NOTIFIER_SHARD_COUNT)
         output_log("Marking apps as notified done")
+    await deliver_outbox(shards)
 
 
 async def init_db():
     output_log("Starting DB")
     output_log("Creating indexes")
-    await db.apps_coll.create_index([("name", 1)], unique=True)
-    await db.apps_coll.create_index([("created", 1)], expireAfterSeconds=APP_EXPIRE_SECS)
-    await db.apps_coll.create_index([("author", "text")])
-    await db.users_coll.create_index([("cid", 1)], unique=True)
+    await db.create_indexes(APP_EXPIRE_SECS)
+    backfilled = await db.backfill_author_keys()
+    if backfilled:
+        output_log(f"Backfilled author keys for {backfilled} apps")
+    backfilled = await db.backfill_developer_keys()
+    if backfilled:
+        output_log(f"Normalized developer subscriptions of {backfilled} users")
     output_log("DB init done")
 
 
+async def open_apps_stream(token):
+    stream = db.watch_new_apps(token, max_await_time_ms=CHANGE_STREAM_MAX_AWAIT_MS)
+    try:
+        # First getMore runs the aggregation, an expired resume token fails here
+        await stream.try_next()
+    except pymongo.errors.OperationFailure as e:
+        if token is None:
+            raise
+        output_log(f"Can't resume apps change stream: {e}", "ERROR")
+        await stream.close()
+        stream = db.watch_new_apps(max_await_time_ms=CHANGE_STREAM_MAX_AWAIT_MS)
+        await stream.try_next()
+
+    return stream
+
+
+async def save_apps_stream_token(stream):
+    if stream.resume_token is not None:
+        await db.save_resume_token(CHANGE_STREAM_NAME, stream.resume_token)
+
+
+async def watch_new_apps():
+    token = await db.get_resume_token(CHANGE_STREAM_NAME)
+    stream = await open_apps_stream(token)
+    async with stream:
+        # Apps stored while the notifier was down are picked up by the first pass
+        await notify_users()
+        await save_apps_stream_token(stream)
+        while True:
+            await stream.next()
+            # Inserts of one spider cycle come in a burst, let it finish
+            await asyncio.sleep(CHANGE_STREAM_BATCH_SECS)
+            while await stream.try_next() is not None:
+                pass
+            await notify_users()
+            await save_apps_stream_token(stream)
+
+
+async def keep_shard_leases():
+    while True:
+        await asyncio.sleep(NOTIFIER_SHARD_LEASE_SECS / 3)
+        if await shard_leases.refresh():
+            # Apps of taken over shards may be waiting since their owner stopped.
+            # The pass runs on its own, a long send must not delay the renewal.
+            task = asyncio.create_task(notify_users())
+            notify_tasks.add(task)
+            task.add_done_callback(notify_tasks.discard)
+
+
 async def start_notifier():
-    await init_db()
+    if NOTIFIER_SHARD_COUNT > 1:
+        output_log(f"Starting as replica {shard_leases.owner} of {NOTIFIER_SHARD_COUNT} shards")
+        await shard_leases.refresh()
+        asyncio.create_task(keep_shard_leases())
+    if CHANGE_STREAM_MODE:
+        if await db.is_replica_set():
+            output_log("Starting apps change stream")
+            await watch_new_apps()
+        output_log("MongoDB is not a replica set, falling back to polling", "WARNING")
+
     output_log("Starting cycle")
     while True:
         await notify_users()
@@ -99,33 +352,126 @@ async def start_notifier():
         await asyncio.sleep(SLEEP_TIMER_SECS)
 
 
+async def retrospective_search(cid: int, agent_id: int):
+    output_log(f"Task found for cid {cid} (agent_id: {agent_id})")
+    dev = await db.get_user_last_developer(cid)
+    if dev:
+        dev = dev[0]
+        apps = await search_cache.search(dev)
+        texts = [NEW_APP_MESSAGE.format(**app) for app in apps]
+        if texts:
+            await send_notifications({cid: texts})
+        else:
+            await scheduler.send(cid, "Nothing found")
+    output_log(f"Task ended for cid {cid} (agent_id: {agent_id})")
+
+
 async def start_retrospective_search_agent(agent_id: int):
     output_log(f"Starting retrospective search agent (agent_id: {agent_id})")
     while True:
-        task = await db.get_rsearch_task()
-        if task:
-            cid = task['cid']
-            output_log(f"Task found for cid {cid} (agent_id: {agent_id})")
-            dev = await db.get_user_last_developer(cid)
-            if dev:
-                dev = dev[0]
-                apps = db.search_apps_by_dev(dev)
-                send_task = []
-                found_flag = False
-                async for app in apps:
-                    text = "New app {name} from {author} released for {countries}:\n{link}".format(**app)
-                    send_task.append(asyncio.create_task(bot.send_message(cid, text)))
-                if not found_flag:
-                    text = "Nothing found"
-                    send_task.append(asyncio.create_task(bot.send_message(cid, text)))
-            output_log(f"Task ended for cid {cid} (agent_id: {agent_id})")
-
-        await asyncio.sleep(RETROSPECTIVE_SEARCH_AGENT_SLEEP_TIMER)
+        task = await db.claim_rsearch_task(
+            RETROSPECTIVE_SEARCH_LEASE_SECS, RETROSPECTIVE_SEARCH_MAX_ATTEMPTS
+        )
+        if not task:
+            break
+        QUEUE_WAIT_SECONDS.observe(
+            (datetime.now(timezone.utc) - task['_id'].generation_time).total_seconds()
+        )
+        try:
+            await retrospective_search(task['cid'], agent_id)
+        except Exception as e:
+            output_log(f"Task for cid {task['cid']} failed: {e!r} (agent_id: {agent_id})", "ERROR")
+            if task.get('attempts', 0) < RETROSPECTIVE_SEARCH_MAX_ATTEMPTS:
+                # Claimed again once the lease expires
+                continue
+            output_log(f"Dropping task for cid {task['cid']} after {task['attempts']} attempts", "ERROR")
+        await db.complete_task(task['_id'])
+    output_log(f"Queue is empty, stopping agent (agent_id: {agent_id})")
 
 
-async def shutdown(loop, signal=None):
-    if signal:
-        output_log(f"Received exit signal {signal.name}")
+async def watch_new_tasks(wakeup: asyncio.Event):
+    async with db.watch_new_tasks() as stream:
+        async for _ in stream:
+            wakeup.set()
+
+
+async def start_retrospective_search_agents():
+    output_log("Starting retrospective search dispatcher")
+    wakeup = asyncio.Event()
+    if await db.is_replica_set():
+        asyncio.create_task(watch_new_tasks(wakeup))
+        # Only expired leases of crashed agents need the periodic check
+        check_timeout = RETROSPECTIVE_SEARCH_LEASE_SECS
+    else:
+        check_timeout = RETROSPECTIVE_SEARCH_POLL_SECS
+
+    agents = set()
+    agent_id = 0
+    # Tasks queued while the notifier was down
+    wakeup.set()
+    while True:
+        try:
+            await asyncio.wait_for(wakeup.wait(), timeout=check_timeout)
+        except asyncio.TimeoutError:
+            pass
+        wakeup.clear()
+        agents = {agent for agent in agents if not agent.done()}
+        exhausted = await db.delete_exhausted_rsearch_tasks(RETROSPECTIVE_SEARCH_MAX_ATTEMPTS)
+        if exhausted:
+            output_log(f"Dropped {exhausted} tasks out of attempts", "ERROR")
+        depth = await db.count_rsearch_tasks(RETROSPECTIVE_SEARCH_MAX_ATTEMPTS)
+        QUEUE_DEPTH.set(depth)
+        for _ in range(min(depth, RETROSPECTIVE_SEARCH_AGENT_COUNT) - len(agents)):
+            agents.add(asyncio.create_task(start_retrospective_search_agent(agent_id)))
+            agent_id += 1
+
+
+async def claim_archive_lease() -> bool:
+    return await db.claim_lease(ARCHIVE_LEASE, shard_leases.owner, ARCHIVE_LEASE_SECS)
+
+
+async def archive_batch(batch: List[Dict]) -> int:
+    # Counted per batch, a run may stop or fail halfway
+    archived = await db.archive_apps(batch, ARCHIVE_BUCKET_DAYS)
+    ARCHIVED_APPS.inc(archived)
+    return archived
+
+
+async def archive_expiring_apps():
+    since = await db.get_archived_until()
+    until = datetime.now() - timedelta(seconds=APP_EXPIRE_SECS - ARCHIVE_LEAD_SECS)
+    archived = 0
+    batch = list()
+    # Archiving is idempotent, a failed run is repeated from the same point
+    async for app in db.get_expiring_apps(since, until):
+        batch.append(app)
+        if len(batch) == ARCHIVE_BATCH_SIZE:
+            # Long runs keep the lease, another replica took it if this one stalled
+            if not await claim_archive_lease():
+                output_log("Archive lease lost, stopping the run", "WARNING")
+                return
+            archived += await archive_batch(batch)
+            batch = list()
+    if batch:
+        archived += await archive_batch(batch)
+    await db.save_archived_until(until)
+    if archived:
+        output_log(f"Archived {archived} apps created before {until}")
+
+
+async def start_archiver():
+    output_log("Starting archiver")
+    while True:
+        try:
+            if await claim_archive_lease():
+                await archive_expiring_apps()
+        except Exception as e:
+            # Retried on the next run
+            output_log(f"Archiving failed: {e!r}", "ERROR")
+        await asyncio.sleep(ARCHIVE_EVERY_SECS)
+
+
+async def wait_admin_notifications():
     for task in asyncio.all_tasks():
         if task.get_name() == NOTIFY_ADMINS_TASK_NAME:
             output_log(f"Waiting for admin notification completion for {NOTIFY_ADMINS_TASK_TIMEOUT} seconds")
@@ -134,12 +480,29 @@ async def shutdown(loop, signal=None):
                 output_log("Admin notifications completed")
             except asyncio.TimeoutError:
                 output_log("Admin notification timeouted", "ERROR")
+
+
+async def close():
+    if NOTIFIER_SHARD_COUNT > 1:
+        output_log("Releasing shard leases")
+        await shard_leases.release()
+    await db.release_lease(ARCHIVE_LEASE, shard_leases.owner)
+    bot_pool.log_stats()
+    output_log("Closing Telegram sessions")
+    await bot_pool.close()
+
+
+async def shutdown(loop, signal=None):
+    if signal:
+        output_log(f"Received exit signal {signal.name}")
+    await wait_admin_notifications()
     tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
     [task.cancel() for task in tasks]
     output_log(f"Cancelling {len(tasks)} tasks")
     await asyncio.gather(*tasks, return_exceptions=True)
+    await close()
     output_log(f"Closing database session")
-    db.client.close()
+    db.close()
     output_log("Done.")
     loop.stop()
 
@@ -159,17 +522,22 @@ def handle_uncaught_exception(loop, context):
 
 
 if __name__ == "__main__":
-    sleep(5)
+    setup_logging()
     loop = db.loop
+    loop.run_until_complete(db.wait_ready())
+    loop.run_until_complete(init_db())
     signals = (signal.SIGHUP, signal.SIGTERM, signal.SIGINT)
     for s in signals:
         loop.add_signal_handler(s, lambda s=s: asyncio.create_task(shutdown(loop, signal=s)))
+    install_profiling_handler(loop, "notifier")
     loop.set_exception_handler(handle_uncaught_exception)
     try:
-        for i in range(RETROSPECTIVE_SEARCH_AGENT_COUNT):
-            loop.create_task(start_retrospective_search_agent(i))
+        loop.create_task(start_metrics_server(METRICS_PORT))
+        loop.create_task(start_retrospective_search_agents())
         loop.create_task(start_notifier())
+        loop.create_task(start_archiver())
         loop.run_forever()
     finally:
         output_log("Successfully shutdown Notifier")
         loop.close()
+        stop_logging()
@@ -0,0 +1,139 @@
+import hashlib
+import sys
+from html.parser import HTMLParser
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+
+class App(NamedTuple):
+    # Apps are identified by link, the name is not unique across developers
+    name: str
+    author: str
+    countries: str
+    link: str
+
+    @property
+    def content_hash(self) -> str:
+        content = "\0".join((self.name, self.author, self.countries))
+        return hashlib.sha1(content.encode()).hexdigest()
+
+
+AppList = List[App]
+
+
+def split_countries(countries: str) -> List[str]:
+    return [country.strip() for country in countries.split(",") if country.strip()]
+
+# (tag, class) of li.app children holding app fields
+APP_FIELDS = {
+    ('span', 'name'): 'name',
+    ('span', 'author'): 'author',
+    ('span', 'countries'): 'countries',
+    ('a', 'download'): 'link',
+}
+
+
+class AppListParser(HTMLParser):
+    # Streaming tokenizer that collects li.app fields without building a tree.
+    # Mirrors the BeautifulSoup lookups: first matching tag in the li.app wins,
+    # text fields are the concatenation of all nested text, link is the href.
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.apps: AppList = []
+        self._app: Optional[Dict[str, str]] = None
+        self._li_depth = 0
+        self._field: Optional[Tuple[str, str]] = None
+        self._field_depth = 0
+        self._field_text: List[str] = []
+
+    def handle_starttag(self, tag, attrs):
+        if self._app is None:
+            if tag == 'li' and self._has_class(attrs, 'app'):
+                self._app = dict()
+                self._li_depth = 0
+            return
+
+        if tag == 'li':
+            self._li_depth += 1
+        if self._field is not None:
+            if tag == self._field[1]:
+                self._field_depth += 1
+            return
+
+        for cls in self._classes(attrs):
+            field = APP_FIELDS.get((tag, cls))
+            if field is None or field in self._app:
+                continue
+            if field == 'link':
+                self._app[field] = dict(attrs).get('href')
+            else:
+                self._field = (field, tag)
+                self._field_depth = 0
+                self._field_text = []
+            break
+
+    def handle_startendtag(self, tag, attrs):
+        # Self-closing tags have no content, only the link field can match
+        if self._app is not None and self._field is None and tag == 'a':
+            if 'download' in self._classes(attrs) and 'link' not in self._app:
+                self._app['link'] = dict(attrs).get('href')
+
+    def handle_endtag(self, tag):
+        if self._app is None:
+            return
+
+        if self._field is not None and tag == self._field[1]:
+            if self._field_depth:
+                self._field_depth -= 1
+            else:
+                self._app[self._field[0]] = ''.join(self._field_text)
+                self._field = None
+            return
+
+        if tag == 'li':
+            if self._li_depth:
+                self._li_depth -= 1
+            else:
+                self._finish_app()
+
+    def handle_data(self, data):
+        if self._field is not None:
+            self._field_text.append(data)
+
+    def close(self):
+        super().close()
+        if self._app is not None:
+            self._finish_app()
+
+    def _finish_app(self):
+        if self._field is not None:
+            self._app[self._field[0]] = ''.join(self._field_text)
+            self._field = None
+        app = self._app
+        self._app = None
+        # Authors and country lists repeat across pages, keep one copy of each
+        self.apps.append(App(
+            name=app['name'],
+            author=sys.intern(app['author'].replace('by ', '')),
+            countries=sys.intern(app['countries'].strip()),
+            link=app['link'],
+        ))
+
+    @staticmethod
+    def _classes(attrs) -> List[str]:
+        for name, value in attrs:
+            if name == 'class' and value:
+                return value.split()
+        return []
+
+    @classmethod
+    def _has_class(cls, attrs, class_name: str) -> bool:
+        return class_name in cls._classes(attrs)
+
+
+def parse_apps(page: str) -> AppList:
+    parser = AppListParser()
+    parser.feed(page)
+    parser.close()
+
+    return parser.apps
@@ -0,0 +1,151 @@
+import asyncio
+import os
+import signal
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from instrumentation import get_output_log
+
+# SIGUSR1 starts a profiling session of PROFILE_DURATION_SECS seconds:
+# stack sampling of the loop thread, tracemalloc, event loop lag and task
+# counts. Results are written to PROFILE_DIR when the session ends.
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "profiles")
+PROFILE_DURATION_SECS = 60
+PROFILE_SIGNAL = signal.SIGUSR1
+SAMPLE_INTERVAL_SECS = 0.005
+LOOP_LAG_INTERVAL_SECS = 0.05
+SLOW_CALLBACK_SECS = 0.1
+TRACEMALLOC_FRAMES = 25
+REPORT_TOP = 20
+
+output_log = get_output_log("profiling")
+
+profile_task: Optional[asyncio.Task] = None
+
+
+class StackSampler(threading.Thread):
+    # Samples the stack of one thread and counts collapsed stacks, which is
+    # the input format of flamegraph tools
+
+    def __init__(self, thread_id: int, interval: float = SAMPLE_INTERVAL_SECS):
+        super().__init__(name="stack-sampler", daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = list()
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                frame = frame.f_back
+            self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+    def top_functions(self, limit: int) -> List[tuple]:
+        functions = Counter()
+        for stack, count in self.stacks.items():
+            functions[stack.rsplit(";", 1)[-1]] += count
+        return functions.most_common(limit)
+
+
+async def watch_loop(duration: float, stats: Dict[str, list]):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + duration
+    while loop.time() < deadline:
+        started = loop.time()
+        await asyncio.sleep(LOOP_LAG_INTERVAL_SECS)
+        lag = loop.time() - started - LOOP_LAG_INTERVAL_SECS
+        stats["lag"].append(lag)
+        stats["tasks"].append(len(asyncio.all_tasks()))
+        if lag > SLOW_CALLBACK_SECS:
+            output_log(f"Event loop was blocked for {lag:.3f} seconds", "WARNING")
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+def write_report(path: str, name: str, duration: float, sampler: StackSampler,
+                 snapshot: tracemalloc.Snapshot, stats: Dict[str, list]):
+    lag, tasks = stats["lag"], stats["tasks"]
+    lines = [
+        f"{name} profile, {duration} seconds, {sampler.samples} stack samples",
+        "",
+        "Event loop lag, seconds:",
+        f"  p50 {percentile(lag, 0.5):.4f}  p99 {percentile(lag, 0.99):.4f}  max {max(lag, default=0):.4f}",
+        f"  over {SLOW_CALLBACK_SECS} seconds: {sum(x > SLOW_CALLBACK_SECS for x in lag)} times",
+        "Asyncio tasks:",
+        f"  min {min(tasks, default=0)}  max {max(tasks, default=0)}  "
+        f"mean {sum(tasks) / len(tasks) if tasks else 0:.1f}",
+        "",
+        "Top sampled functions:",
+    ]
+    lines += [f"  {count:8} {function}" for function, count in sampler.top_functions(REPORT_TOP)]
+    lines += ["", "Top allocations:"]
+    lines += [f"  {stat}" for stat in snapshot.statistics("lineno")[:REPORT_TOP]]
+    with open(path, "w") as file:
+        file.write("\n".join(lines) + "\n")
+
+
+async def run_profile(name: str, duration: Optional[float] = None):
+    loop = asyncio.get_running_loop()
+    duration = duration or PROFILE_DURATION_SECS
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    prefix = os.path.join(PROFILE_DIR, f"{name}-{datetime.now():%Y%m%d-%H%M%S}")
+    output_log(f"Profiling for {duration} seconds into {prefix}.*")
+
+    started_tracemalloc = not tracemalloc.is_tracing()
+    if started_tracemalloc:
+        tracemalloc.start(TRACEMALLOC_FRAMES)
+    debug = loop.get_debug()
+    # Debug mode makes asyncio log callbacks slower than slow_callback_duration
+    loop.slow_callback_duration = SLOW_CALLBACK_SECS
+    loop.set_debug(True)
+    sampler = StackSampler(threading.get_ident())
+    sampler.start()
+    stats = {"lag": [], "tasks": []}
+    started = time.monotonic()
+    try:
+        await watch_loop(duration, stats)
+    finally:
+        sampler.stop()
+        loop.set_debug(debug)
+        snapshot = tracemalloc.take_snapshot()
+        if started_tracemalloc:
+            tracemalloc.stop()
+
+    snapshot.dump(f"{prefix}.tracemalloc")
+    with open(f"{prefix}.folded", "w") as file:
+        file.writelines(f"{stack} {count}\n" for stack, count in sampler.stacks.items())
+    write_report(f"{prefix}.txt", name, round(time.monotonic() - started, 1), sampler, snapshot, stats)
+    output_log(f"Profile written to {prefix}.txt")
+
+
+def install_profiling_handler(loop: asyncio.AbstractEventLoop, name: str):
+    def start_profile():
+        global profile_task
+        if profile_task is not None and not profile_task.done():
+            output_log("Profiling is already running", "WARNING")
+            return
+        profile_task = loop.create_task(run_profile(name))
+
+    loop.add_signal_handler(PROFILE_SIGNAL, start_profile)
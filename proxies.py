@@ -0,0 +1,175 @@
+import asyncio
+import random
+import time
+from aiohttp import ClientConnectionError
+from aiohttp_socks import ProxyError
+from contextlib import asynccontextmanager
+from typing import Any, Callable, Dict, List, Optional
+
+from instrumentation import PROXY_HEALTHY, PROXY_LATENCY_SECONDS, PROXY_REQUESTS, get_output_log
+
+PROXY_PROTO = "socks5"
+
+# Latency and error rate are exponentially smoothed per request. A proxy is
+# ejected after consecutive failures or a high error rate and probed with a
+# single request when the ejection ends, a failed probe doubles the ejection.
+SMOOTHING = 0.2
+EJECT_CONSECUTIVE_FAILURES = 3
+EJECT_ERROR_RATE = 0.5
+EJECT_MIN_REQUESTS = 10
+EJECT_SECS = 30
+EJECT_MAX_SECS = 600
+
+# Errors of the connection through the proxy, as opposed to answers of the
+# upstream server that the proxy passed on
+CONNECTION_ERRORS = (ClientConnectionError, ProxyError, OSError, asyncio.TimeoutError)
+
+output_log = get_output_log("proxies")
+
+
+def get_proxy_url(proxy: Dict) -> str:
+    return (
+        f"{proxy.get('proxy_proto', PROXY_PROTO)}://{proxy['proxy_user']}:{proxy['proxy_pass']}"
+        f"@{proxy['proxy_host']}:{proxy['proxy_port']}"
+    )
+
+
+def load_proxy_urls(secrets: Dict) -> List[str]:
+    # Secrets have a "proxies" list or the single proxy_* keys
+    return [get_proxy_url(proxy) for proxy in secrets.get("proxies") or [secrets]]
+
+
+class Proxy:
+    def __init__(self, url: Optional[str], client: Any):
+        self.url = url
+        # Host and port only, credentials stay out of logs and metrics
+        self.name = url.rsplit("@", 1)[-1] if url else "direct"
+        self.client = client
+        self.latency = 0.0
+        self.error_rate = 0.0
+        self.requests = 0
+        self.errors = 0
+        self.consecutive_failures = 0
+        self.in_flight = 0
+        self.ejected_until = 0.0
+        self.eject_secs = EJECT_SECS
+
+    def is_ejected(self, now: float) -> bool:
+        return self.ejected_until > now
+
+    def is_probing(self, now: float) -> bool:
+        # Ejection is over but no request succeeded since
+        return bool(self.ejected_until) and not self.is_ejected(now)
+
+    def score(self) -> float:
+        # Untried proxies score best while idle, so every proxy gets measured
+        return (self.latency + 0.001) * (1 + self.in_flight) * (1 + self.error_rate)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "proxy": self.name,
+            "latency": self.latency,
+            "error_rate": self.error_rate,
+            "requests": self.requests,
+            "errors": self.errors,
+            "in_flight": self.in_flight,
+            "ejected": self.is_ejected(time.monotonic()),
+        }
+
+
+class ProxyPool:
+    # Clients (HTTP sessions, bots) bound to one proxy each. Requests go to the
+    # less loaded of two random healthy proxies.
+
+    def __init__(self, name: str, urls: List[Optional[str]], make_client: Callable[[Optional[str]], Any],
+                 is_failure: Callable[[Exception], bool]):
+        self.name = name
+        self.is_failure = is_failure
+        self.proxies = [Proxy(url, make_client(url)) for url in urls]
+        for proxy in self.proxies:
+            PROXY_HEALTHY.set(1, pool=self.name, proxy=proxy.name)
+
+    def __len__(self) -> int:
+        return len(self.proxies)
+
+    @property
+    def primary(self) -> Any:
+        return self.proxies[0].client
+
+    def choose(self) -> Proxy:
+        now = time.monotonic()
+        healthy = [
+            p for p in self.proxies
+            if not p.is_ejected(now) and not (p.is_probing(now) and p.in_flight)
+        ]
+        if not healthy:
+            # Everything is ejected, the one back soonest is the best guess
+            return min(self.proxies, key=lambda p: p.ejected_until)
+        if len(healthy) == 1:
+            return healthy[0]
+        return min(random.sample(healthy, 2), key=Proxy.score)
+
+    @asynccontextmanager
+    async def client(self):
+        proxy = self.choose()
+        proxy.in_flight += 1
+        started = time.monotonic()
+        try:
+            yield proxy.client
+        except Exception as e:
+            # Other errors got through the proxy, they count as its success
+            self.record(proxy, time.monotonic() - started, ok=not self.is_failure(e))
+            raise
+        else:
+            self.record(proxy, time.monotonic() - started, ok=True)
+        finally:
+            proxy.in_flight -= 1
+
+    def record(self, proxy: Proxy, latency: float, ok: bool):
+        now = time.monotonic()
+        proxy.requests += 1
+        proxy.latency = latency if proxy.requests == 1 else (
+            SMOOTHING * latency + (1 - SMOOTHING) * proxy.latency
+        )
+        proxy.error_rate = SMOOTHING * (not ok) + (1 - SMOOTHING) * proxy.error_rate
+        PROXY_REQUESTS.inc(pool=self.name, proxy=proxy.name, result="ok" if ok else "error")
+        PROXY_LATENCY_SECONDS.set(proxy.latency, pool=self.name, proxy=proxy.name)
+
+        if ok:
+            proxy.consecutive_failures = 0
+            if proxy.is_probing(now):
+                output_log(f"Proxy {proxy.name} of {self.name} pool is back")
+                proxy.ejected_until = 0.0
+                proxy.eject_secs = EJECT_SECS
+                PROXY_HEALTHY.set(1, pool=self.name, proxy=proxy.name)
+            return
+
+        proxy.errors += 1
+        proxy.consecutive_failures += 1
+        if proxy.is_probing(now):
+            proxy.eject_secs = min(proxy.eject_secs * 2, EJECT_MAX_SECS)
+        elif proxy.is_ejected(now) or not (
+            proxy.consecutive_failures >= EJECT_CONSECUTIVE_FAILURES
+            or (proxy.requests >= EJECT_MIN_REQUESTS and proxy.error_rate >= EJECT_ERROR_RATE)
+        ):
+            return
+        # Single proxy has nowhere to move the traffic to
+        if len(self.proxies) > 1:
+            output_log(f"Ejecting proxy {proxy.name} of {self.name} pool for {proxy.eject_secs} seconds", "WARNING")
+            proxy.ejected_until = now + proxy.eject_secs
+            PROXY_HEALTHY.set(0, pool=self.name, proxy=proxy.name)
+
+    def stats(self) -> List[Dict[str, Any]]:
+        return [proxy.stats() for proxy in self.proxies]
+
+    def log_stats(self):
+        for stats in self.stats():
+            output_log(
+                f"Proxy {stats['proxy']} of {self.name} pool: {stats['requests']} requests, "
+                f"{stats['errors']} errors, latency {stats['latency']:.3f}s, "
+                f"error rate {stats['error_rate']:.2f}{', ejected' if stats['ejected'] else ''}"
+            )
+
+    async def close(self):
+        for proxy in self.proxies:
+            await proxy.client.close()
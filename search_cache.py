@@ -0,0 +1,121 @@
+import time
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from storage import db
+from cache import LRUCache
+from developers import normalize_developer
+from instrumentation import SEARCH_CACHE_REQUESTS, get_output_log
+
+SEARCH_CACHE_SIZE = 1000
+SEARCH_CACHE_TTL_SECS = 600
+# Author versions are polled at most this often and only on searches
+SEARCH_CACHE_SYNC_SECS = 10
+# Bigger results (short prefixes) are not cached and are read page by page
+SEARCH_CACHE_MAX_APPS = 500
+
+output_log = get_output_log("search_cache")
+
+
+class SearchCache:
+    # Developer search results by normalized developer and prefix flag. The
+    # spider bumps the version of every author with new or changed apps, the
+    # cache drops only the results of the bumped authors and of the prefixes
+    # they start with.
+
+    def __init__(self, max_size: int, ttl_secs: float, sync_secs: float):
+        self.entries = LRUCache(max_size, ttl_secs)
+        # Keys known to have more than SEARCH_CACHE_MAX_APPS apps
+        self.oversized = LRUCache(max_size, ttl_secs)
+        self.prefixes: Set[str] = set()
+        self.sync_secs = sync_secs
+        self.synced = 0.0
+        self.version: Optional[int] = None
+        # Authors of the current version that are already invalidated
+        self.version_authors: Set[str] = set()
+        # Changes on every invalidation, results read before are not stored
+        self.generation = 0
+
+    async def sync(self):
+        now = time.monotonic()
+        if now - self.synced < self.sync_secs:
+            return
+        self.synced = now
+        if self.version is None:
+            # Nothing is cached yet, only the starting point is needed
+            self.version = await db.get_search_version()
+            return
+
+        versions = await db.get_author_versions(self.version)
+        changed = [
+            author for author, version in versions.items()
+            if version > self.version or author not in self.version_authors
+        ]
+        if not changed:
+            return
+        self.invalidate(changed)
+        latest = max(versions.values())
+        if latest > self.version:
+            self.version = latest
+            self.version_authors = set()
+        self.version_authors.update(author for author, version in versions.items() if version == latest)
+        output_log(f"Dropped cached searches of {len(changed)} changed authors")
+
+    def invalidate(self, author_keys: Iterable[str]):
+        author_keys = list(author_keys)
+        for author_key in author_keys:
+            self.entries.invalidate((author_key, False))
+        for prefix in [p for p in self.prefixes if any(key.startswith(p) for key in author_keys)]:
+            self.entries.invalidate((prefix, True))
+            self.prefixes.discard(prefix)
+        self.generation += 1
+
+    async def get(self, dev: str, prefix: bool = False) -> Optional[List[Dict]]:
+        # Same order as db.search_apps_by_dev, the list must not be changed.
+        # None when the result is too big to cache.
+        await self.sync()
+        key = (normalize_developer(dev.strip('"')), prefix)
+        apps = self.entries.get(key)
+        if apps is not None:
+            SEARCH_CACHE_REQUESTS.inc(result="hit")
+            return apps
+        if key in self.oversized:
+            SEARCH_CACHE_REQUESTS.inc(result="oversized")
+            return None
+
+        SEARCH_CACHE_REQUESTS.inc(result="miss")
+        generation = self.generation
+        apps = await db.search_apps_by_dev(dev, prefix=prefix, limit=SEARCH_CACHE_MAX_APPS + 1).to_list(None)
+        if len(apps) > SEARCH_CACHE_MAX_APPS:
+            self.oversized.set(key, True)
+            return None
+        if generation == self.generation:
+            self.entries.set(key, apps)
+            if prefix:
+                self.add_prefix(key[0])
+        return apps
+
+    async def search(self, dev: str, prefix: bool = False) -> List[Dict]:
+        apps = await self.get(dev, prefix)
+        if apps is None:
+            apps = await db.search_apps_by_dev(dev, prefix=prefix).to_list(None)
+        return apps
+
+    async def search_page(self, dev: str, prefix: bool = False, skip: int = 0,
+                          limit: int = 0) -> Tuple[int, List[Dict]]:
+        # Total count and one page of the results
+        apps = await self.get(dev, prefix)
+        if apps is not None:
+            return len(apps), apps[skip:skip + limit] if limit else apps[skip:]
+        total = await db.count_apps_by_dev(dev, prefix=prefix)
+        apps = await db.search_apps_by_dev(dev, prefix=prefix, skip=skip, limit=limit).to_list(None)
+        return total, apps
+
+    def add_prefix(self, prefix: str):
+        self.prefixes.add(prefix)
+        if len(self.prefixes) > self.entries.max_size:
+            # Forget prefixes whose entries were evicted or expired
+            self.prefixes = {p for p in self.prefixes if (p, True) in self.entries}
+
+
+# Shared by the bot and the retrospective search agents in one process
+search_cache = SearchCache(SEARCH_CACHE_SIZE, SEARCH_CACHE_TTL_SECS, SEARCH_CACHE_SYNC_SECS)
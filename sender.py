@@ -0,0 +1,143 @@
+import asyncio
+import random
+import time
+from aiogram.utils.exceptions import NetworkError, RetryAfter, TelegramAPIError
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from instrumentation import SEND_SECONDS, SENDS, TELEGRAM_ERRORS, get_output_log
+from proxies import ProxyPool
+
+# Telegram limits: about 30 messages per second overall and 1 per second per chat
+GLOBAL_RATE = 30
+GLOBAL_BURST = 30
+CHAT_RATE = 1
+CHAT_BURST = 3
+SEND_RETRIES = 3
+NETWORK_BACKOFF_SECS = 1
+CHAT_BUCKETS_MAX = 10000
+
+MESSAGE_MAX_LENGTH = 4096
+DIGEST_SEPARATOR = "\n\n"
+
+# Send results: a failed message is refused by Telegram for good (blocked bot,
+# bad chat), a message to retry ran out of attempts on network errors
+SEND_OK = "ok"
+SEND_FAILED = "failed"
+SEND_RETRY = "retry"
+
+
+output_log = get_output_log("sender")
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def reserve(self) -> float:
+        # Takes a token and returns how long to wait before it may be used.
+        # Tokens go negative so concurrent callers queue up behind each other.
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return max(0.0, -self.tokens / self.rate)
+
+    def is_full(self) -> bool:
+        now = time.monotonic()
+        return self.tokens + (now - self.updated) * self.rate >= self.capacity
+
+
+class SendScheduler:
+    def __init__(self, bots: ProxyPool, global_rate=GLOBAL_RATE, chat_rate=CHAT_RATE):
+        self.bots = bots
+        self.global_bucket = TokenBucket(global_rate, GLOBAL_BURST)
+        self.chat_rate = chat_rate
+        self.chat_buckets: Dict[int, TokenBucket] = dict()
+
+    def _chat_bucket(self, cid: int) -> TokenBucket:
+        bucket = self.chat_buckets.get(cid)
+        if bucket is None:
+            if len(self.chat_buckets) >= CHAT_BUCKETS_MAX:
+                self.chat_buckets = {
+                    c: b for c, b in self.chat_buckets.items() if not b.is_full()
+                }
+            bucket = self.chat_buckets[cid] = TokenBucket(self.chat_rate, CHAT_BURST)
+        return bucket
+
+    async def _acquire(self, cid: int):
+        await asyncio.sleep(self._chat_bucket(cid).reserve())
+        await asyncio.sleep(self.global_bucket.reserve())
+
+    async def send(self, cid: int, text: str, **kwargs) -> bool:
+        return await self.send_status(cid, text, **kwargs) == SEND_OK
+
+    async def send_status(self, cid: int, text: str, **kwargs) -> str:
+        with SEND_SECONDS.time():
+            return await self._send(cid, text, **kwargs)
+
+    async def _send(self, cid: int, text: str, **kwargs) -> str:
+        for attempt in range(1, SEND_RETRIES + 1):
+            await self._acquire(cid)
+            try:
+                async with self.bots.client() as bot:
+                    await bot.send_message(cid, text, **kwargs)
+                SENDS.inc()
+                return SEND_OK
+            except RetryAfter as e:
+                TELEGRAM_ERRORS.inc(error=type(e).__name__)
+                output_log(f"Flood control for cid {cid}, retrying in {e.timeout} seconds", "WARNING")
+                await asyncio.sleep(e.timeout)
+            except (NetworkError, asyncio.TimeoutError) as e:
+                # Proxy trouble, the next attempt goes through another proxy
+                TELEGRAM_ERRORS.inc(error=type(e).__name__)
+                # Full jitter exponential backoff
+                delay = random.uniform(0, NETWORK_BACKOFF_SECS * 2 ** (attempt - 1))
+                output_log(
+                    f"Network error sending message to cid {cid}: {e!r}. Retrying in {delay:.1f} seconds",
+                    "WARNING",
+                )
+                await asyncio.sleep(delay)
+            except TelegramAPIError as e:
+                TELEGRAM_ERRORS.inc(error=type(e).__name__)
+                output_log(f"Can't send message to cid {cid}: {e}", "ERROR")
+                return SEND_FAILED
+        output_log(f"Giving up sending message to cid {cid} after {SEND_RETRIES} attempts", "ERROR")
+        return SEND_RETRY
+
+    async def send_many(self, messages: Iterable[Tuple[int, str]]) -> List[bool]:
+        tasks = [asyncio.create_task(self.send(cid, text)) for cid, text in messages]
+        if not tasks:
+            return []
+        return await asyncio.gather(*tasks)
+
+    async def send_digest(self, cid: int, texts: List[str], title: Optional[str] = None) -> List[bool]:
+        return await self.send_many((cid, text) for text in build_digests(texts, title))
+
+
+def build_digests(texts: List[str], title: Optional[str] = None) -> List[str]:
+    return [digest for digest, _ in build_digest_groups(texts, title)]
+
+
+def build_digest_groups(texts: List[str], title: Optional[str] = None) -> List[Tuple[str, List[int]]]:
+    # Merges texts into as few messages as the Telegram length limit allows,
+    # every message comes with the indexes of the texts it holds
+    if len(texts) < 2:
+        return [(text, [i]) for i, text in enumerate(texts)]
+
+    digests = list()
+    current = title or ""
+    indexes = list()
+    for i, text in enumerate(texts):
+        candidate = current + DIGEST_SEPARATOR + text if current else text
+        if len(candidate) > MESSAGE_MAX_LENGTH and current:
+            digests.append((current, indexes))
+            candidate = text
+            indexes = list()
+        current = candidate
+        indexes.append(i)
+    digests.append((current, indexes))
+
+    return digests
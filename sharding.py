@@ -0,0 +1,62 @@
+import math
+import os
+import socket
+import uuid
+from typing import List, Set
+
+from instrumentation import get_output_log
+from storage import db
+
+# Users are split into shards by abs(cid) % shard_count. Every notifier replica keeps a
+# heartbeat lease and holds leases on its fair share of shards, so a dead
+# replica's shards are taken over when its leases expire.
+REPLICA_LEASE_PREFIX = "notifier_replica:"
+SHARD_LEASE_PREFIX = "notifier_shard:"
+
+output_log = get_output_log("sharding")
+
+
+class ShardLeases:
+    def __init__(self, shard_count: int, lease_secs: float):
+        self.shard_count = shard_count
+        self.lease_secs = lease_secs
+        self.owner = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.owned: Set[int] = set()
+
+    @property
+    def shards(self) -> List[int]:
+        return sorted(self.owned)
+
+    async def refresh(self) -> Set[int]:
+        await db.claim_lease(REPLICA_LEASE_PREFIX + self.owner, self.owner, self.lease_secs)
+        replicas = await db.get_lease_owners(REPLICA_LEASE_PREFIX)
+        fair_share = math.ceil(self.shard_count / max(len(replicas), 1))
+
+        owned = set()
+        for shard in self.shards:
+            if await db.claim_lease(SHARD_LEASE_PREFIX + str(shard), self.owner, self.lease_secs):
+                owned.add(shard)
+        # Give shards back when replicas joined, others pick them up
+        while len(owned) > fair_share:
+            shard = max(owned)
+            await db.release_lease(SHARD_LEASE_PREFIX + str(shard), self.owner)
+            owned.discard(shard)
+        for shard in range(self.shard_count):
+            if len(owned) >= fair_share:
+                break
+            if shard in owned:
+                continue
+            if await db.claim_lease(SHARD_LEASE_PREFIX + str(shard), self.owner, self.lease_secs):
+                owned.add(shard)
+
+        gained = owned - self.owned
+        if owned != self.owned:
+            output_log(f"Replica {self.owner} owns shards {sorted(owned)} of {self.shard_count}")
+        self.owned = owned
+        return gained
+
+    async def release(self):
+        for shard in self.shards:
+            await db.release_lease(SHARD_LEASE_PREFIX + str(shard), self.owner)
+        await db.release_lease(REPLICA_LEASE_PREFIX + self.owner, self.owner)
+        self.owned = set()
@@ -1,116 +1,263 @@
 import asyncio
+import hashlib
+import random
 import signal
 import json
-from aiohttp import ClientSession
-from aiohttp_socks import ProxyConnector
-from bs4 import BeautifulSoup
-from datetime import datetime
-from time import sleep
-from typing import Dict, List
+from aiohttp import ClientError, ClientResponseError, ClientSession, ClientTimeout
+from aiohttp_socks import ProxyConnector, ProxyError
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional, Tuple
 
-import database as db
+from storage import db
+from instrumentation import (
+    DUPLICATE_APPS, FETCH_SECONDS, INSERT_SECONDS, NEW_APPS, PARSE_SECONDS, UPDATED_APPS,
+    get_output_log, setup_logging, start_metrics_server, stop_logging,
+)
+from profiling import install_profiling_handler
+import parsing
+from parsing import AppList
+from proxies import CONNECTION_ERRORS, ProxyPool, load_proxy_urls
 
 SECRETS_FILE = "secrets/http_proxy.json"
 with open(SECRETS_FILE) as file:
     secrets = json.load(file)
 
-PROXY_HOST = secrets["proxy_host"]
-PROXY_PORT = secrets["proxy_port"]
-PROXY_USER = secrets["proxy_user"]
-PROXY_PASS = secrets["proxy_pass"]
-PROXY_PROTO = "socks5"
-PROXY_URL = f"{PROXY_PROTO}://{PROXY_USER}:{PROXY_PASS}@{PROXY_HOST}:{PROXY_PORT}"
-
-
-AppList = List[Dict[str, str]]
+PROXY_URLS = load_proxy_urls(secrets)
+# Storeglide answering 403 or 429 to one proxy is the usual sign of its
+# address being blocked, other statuses are not the proxy's fault
+PROXY_BLOCKED_STATUSES = (403, 429)
+FETCH_ERRORS = (ClientError, ProxyError, OSError, asyncio.TimeoutError)
 
 STOREGLIDE_URL = "https://store.storeglide.com/"
 STOREGLIDE_PAGES_DEEP = 10
 SLEEP_TIMER_SECS = 300
+METRICS_PORT = 9101
+# Incremental mode walks pages one by one and stops on the first page
+# without new apps. Every FULL_SWEEP_EVERY_CYCLES cycle is a full-depth one.
+INCREMENTAL_CRAWL = True
+INCREMENTAL_PAGES_DEEP = STOREGLIDE_PAGES_DEEP
+FULL_SWEEP_EVERY_CYCLES = 12
+
+PAGE_FETCH_CONCURRENCY = 3
+PAGE_FETCH_TIMEOUT_SECS = 30
+PAGE_FETCH_RETRIES = 3
+PAGE_FETCH_BACKOFF_SECS = 2
+
+# Pages are parsed in worker threads so the loop keeps serving downloads
+PARSER_WORKERS = 2
+parser_executor = ThreadPoolExecutor(max_workers=PARSER_WORKERS, thread_name_prefix="parser")
+
+# Fingerprints (ETag, Last-Modified, content hash) of processed pages by url.
+# New fingerprints are saved only after the page apps are parsed and inserted,
+# a page that failed either is processed again on the next cycle.
+page_cache: Dict[str, Dict[str, str]] = dict()
+Fingerprints = Dict[str, Dict[str, str]]
+
+
+output_log = get_output_log("spider")
+
+
+def create_session(proxy_url: str) -> ClientSession:
+    connector = ProxyConnector.from_url(
+        proxy_url,
+        limit=PAGE_FETCH_CONCURRENCY,
+        keepalive_timeout=SLEEP_TIMER_SECS * 2,
+    )
+    timeout = ClientTimeout(total=PAGE_FETCH_TIMEOUT_SECS)
+    return ClientSession(connector=connector, timeout=timeout)
 
 
-def output_log(message, level="INFO"):
-    n = datetime.now()
-    ns = n.strftime("%Y-%m-%d %H:%M:%S")
-    print(f"{ns} " + f"[{level.upper()}".ljust(10, " ") + f"] {message}")
+def is_proxy_failure(e: Exception) -> bool:
+    if isinstance(e, ClientResponseError):
+        return e.status in PROXY_BLOCKED_STATUSES
+    return isinstance(e, CONNECTION_ERRORS)
 
 
-async def get_storeglide_page(session: ClientSession, page=1):
+def create_proxy_pool() -> ProxyPool:
+    # One session per proxy, PAGE_FETCH_CONCURRENCY connections each
+    return ProxyPool("storeglide", PROXY_URLS, create_session, is_proxy_failure)
+
+
+async def load_page_cache():
+    output_log("Loading page fingerprints")
+    async for fingerprint in db.get_page_fingerprints():
+        page_cache[fingerprint["url"]] = {
+            "etag": fingerprint.get("etag"),
+            "last_modified": fingerprint.get("last_modified"),
+            "content_hash": fingerprint.get("content_hash"),
+        }
+    output_log(f"Loaded {len(page_cache)} page fingerprints")
+
+
+async def commit_page_fingerprints(fingerprints: Fingerprints):
+    for url, fingerprint in fingerprints.items():
+        await db.save_page_fingerprint(url, fingerprint)
+        page_cache[url] = fingerprint
+
+
+async def get_storeglide_page(pool: ProxyPool, page=1) -> Tuple[Optional[str], Fingerprints]:
+    # Page text unless it is unchanged and the page fingerprint if it is new
     output_log(f"Getting storeglide page {page}")
     url = STOREGLIDE_URL + f"?page={page}"
-    async with session.get(url) as resp:
-        result = await resp.text()
-    return result
+    cached = page_cache.get(url, {})
+    headers = dict()
+    if cached.get("etag"):
+        headers["If-None-Match"] = cached["etag"]
+    if cached.get("last_modified"):
+        headers["If-Modified-Since"] = cached["last_modified"]
+
+    with FETCH_SECONDS.time():
+        async with pool.client() as session, session.get(url, headers=headers) as resp:
+            if resp.status == 304:
+                output_log(f"Page {page} not modified")
+                return None, {}
+            resp.raise_for_status()
+            result = await resp.text()
+            fingerprint = {
+                "etag": resp.headers.get("ETag"),
+                "last_modified": resp.headers.get("Last-Modified"),
+                "content_hash": hashlib.sha1(result.encode()).hexdigest(),
+            }
 
+    fingerprints = {url: fingerprint} if fingerprint != cached else {}
+    if fingerprint["content_hash"] == cached.get("content_hash"):
+        output_log(f"Page {page} content unchanged")
+        return None, fingerprints
+    return result, fingerprints
 
-async def get_storeglide_pages_deep(session: ClientSession) -> List[str]:
+
+async def fetch_storeglide_page(pool: ProxyPool, page=1) -> Tuple[Optional[str], Fingerprints]:
+    # Every attempt picks a proxy anew, a retry usually goes through another one
+    for attempt in range(1, PAGE_FETCH_RETRIES + 1):
+        try:
+            return await get_storeglide_page(pool, page)
+        except FETCH_ERRORS as e:
+            if attempt == PAGE_FETCH_RETRIES:
+                raise
+            # Full jitter exponential backoff
+            delay = random.uniform(0, PAGE_FETCH_BACKOFF_SECS * 2 ** (attempt - 1))
+            output_log(f"Page {page} attempt {attempt} failed: {e!r}. Retrying in {delay:.1f} seconds", "WARNING")
+            await asyncio.sleep(delay)
+
+
+async def get_storeglide_apps_deep(pool: ProxyPool) -> Tuple[AppList, Fingerprints]:
     output_log("Getting storeglide pages")
-    tasks = []
-    for i in range(1, STOREGLIDE_PAGES_DEEP + 1):
-        tasks.append(asyncio.create_task(
-            get_storeglide_page(session, i)
-        ))
-    results = await asyncio.gather(*tasks)
-    output_log("Pages download done")
+    semaphore = asyncio.Semaphore(PAGE_FETCH_CONCURRENCY * len(pool))
+    fingerprints: Fingerprints = dict()
 
-    return results
+    async def fetch_and_parse(page: int) -> AppList:
+        async with semaphore:
+            result, page_fingerprints = await fetch_storeglide_page(pool, page)
+        apps = [] if result is None else await parse_page_for_apps(result)
+        fingerprints.update(page_fingerprints)
+        return apps
+
+    pages = range(1, STOREGLIDE_PAGES_DEEP + 1)
+    tasks = [asyncio.create_task(fetch_and_parse(i)) for i in pages]
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    parsed_apps = list()
+    failed_pages = list()
+    for i, result in zip(pages, results):
+        if isinstance(result, Exception):
+            output_log(f"Page {i} download or parsing failed: {result!r}", "ERROR")
+            failed_pages.append(i)
+        else:
+            parsed_apps += result
+    output_log(f"Pages download done, failed pages: {failed_pages}")
 
+    return parsed_apps, fingerprints
 
-def parse_page_for_apps(page: str) -> AppList:
+
+async def parse_page_for_apps(page: str) -> AppList:
     output_log("Starting page parsing")
-    soup = BeautifulSoup(page, 'html.parser')
-    apps = soup.find_all('li', {'class': 'app'})
-    parsed_apps = []
-    for app in apps:
-        name = app.find('span', {'class': 'name'}).text
-        author = app.find('span', {'class': 'author'}).text.replace('by ', '')
-        countries = app.find('span', {'class': 'countries'}).text.strip()
-        link = app.find('a', {'class': 'download'}).get('href')
-        app_info = {
-            'name': name,
-            'author': author,
-            'countries': countries,
-            'link': link
-        }
-        parsed_apps.append(app_info)
-    if not apps:
+    loop = asyncio.get_running_loop()
+    with PARSE_SECONDS.time():
+        parsed_apps = await loop.run_in_executor(parser_executor, parsing.parse_apps, page)
+    if not parsed_apps:
         output_log("No apps found after parsing", "ERROR")
     output_log("Parsing done")
     return parsed_apps
 
 
-def parse_pages(page_list: List[str]) -> AppList:
-    output_log("Starting pages parsing")
-    parsed_apps = list()
-    for page in page_list:
-        parsed_apps += parse_page_for_apps(page)
-    output_log("All pages parsing done")
+async def get_storeglide_apps_incremental(pool: ProxyPool) -> Tuple[AppList, Fingerprints]:
+    output_log("Getting storeglide pages incrementally")
+    new_apps = list()
+    fingerprints: Fingerprints = dict()
+    for i in range(1, INCREMENTAL_PAGES_DEEP + 1):
+        try:
+            page, page_fingerprints = await fetch_storeglide_page(pool, i)
+        except FETCH_ERRORS as e:
+            output_log(f"Page {i} download failed: {e!r}", "ERROR")
+            break
+        # Unchanged page means nothing was pushed down to the deeper ones
+        if page is None:
+            fingerprints.update(page_fingerprints)
+            break
+        apps = await parse_page_for_apps(page)
+        fingerprints.update(page_fingerprints)
+        known = await db.get_known_apps([app.link for app in apps])
+        page_new_apps = [
+            app for app in apps
+            if app.link not in known or known[app.link].get("content_hash") != app.content_hash
+        ]
+        output_log(f"Found {len(page_new_apps)} new or changed apps on page {i}")
+        if not page_new_apps:
+            break
+        new_apps += page_new_apps
+    output_log("Incremental download done")
 
-    return parsed_apps
+    return new_apps, fingerprints
 
 
 async def insert_apps(apps: AppList):
     output_log("Inserting apps")
-    tasks = [
-        asyncio.create_task(db.create_app(app)) for app in apps
-    ]
+    with INSERT_SECONDS.time():
+        result = await db.create_apps(apps)
+    NEW_APPS.inc(result["inserted"])
+    UPDATED_APPS.inc(result["updated"])
+    DUPLICATE_APPS.inc(result["skipped"])
+    output_log(
+        f"Inserted {result['inserted']} apps, updated {result['updated']} changed apps, "
+        f"skipped {result['skipped']} known apps"
+    )
+    # Search caches of the bot and the notifier drop only these authors
+    await db.bump_author_versions(result["author_keys"])
+    return result
+
 
-    results = await asyncio.gather(*tasks)
-    output_log(f"Insert results: {results}")
-    return results
+async def run_spider_cycle(pool: ProxyPool, full_sweep: bool) -> AppList:
+    if full_sweep:
+        apps, fingerprints = await get_storeglide_apps_deep(pool)
+    else:
+        apps, fingerprints = await get_storeglide_apps_incremental(pool)
+
+    # Failed insert leaves the fingerprints unsaved
+    if apps:
+        await insert_apps(apps)
+    await commit_page_fingerprints(fingerprints)
+    return apps
 
 
 async def start_spider():
+    await load_page_cache()
     output_log("Starting cycle")
-    while True:
-        connector = ProxyConnector.from_url(PROXY_URL)
-        async with ClientSession(connector=connector) as session:
-            pages = await get_storeglide_pages_deep(session)
+    cycle = 0
+    pool = create_proxy_pool()
+    try:
+        while True:
+            full_sweep = not INCREMENTAL_CRAWL or cycle % FULL_SWEEP_EVERY_CYCLES == 0
+            await run_spider_cycle(pool, full_sweep)
+            pool.log_stats()
+            cycle += 1
+            output_log(f"Sleeping for {SLEEP_TIMER_SECS} seconds")
+            await asyncio.sleep(SLEEP_TIMER_SECS)
+    finally:
+        await pool.close()
 
-        apps = parse_pages(pages)
-        await insert_apps(apps)
-        output_log(f"Sleeping for {SLEEP_TIMER_SECS} seconds")
-        await asyncio.sleep(SLEEP_TIMER_SECS)
+
+async def close():
+    output_log("Stopping parser workers")
+    parser_executor.shutdown(wait=False)
 
 
 async def shutdown(loop, signal=None):
@@ -120,8 +267,9 @@ async def shutdown(loop, signal=None):
     [task.cancel() for task in tasks]
     output_log(f"Cancelling {len(tasks)} tasks")
     await asyncio.gather(*tasks, return_exceptions=True)
+    await close()
     output_log(f"Closing database session")
-    db.client.close()
+    db.close()
     output_log("Done.")
     loop.stop()
 
@@ -134,15 +282,19 @@ def handle_uncaught_exception(loop, context):
 
 
 if __name__ == "__main__":
-    sleep(5)
+    setup_logging()
     loop = db.loop
+    loop.run_until_complete(db.wait_ready())
     signals = (signal.SIGHUP, signal.SIGTERM, signal.SIGINT)
     for s in signals:
         loop.add_signal_handler(s, lambda s=s: asyncio.create_task(shutdown(loop, signal=s)))
+    install_profiling_handler(loop, "spider")
     loop.set_exception_handler(handle_uncaught_exception)
     try:
+        loop.create_task(start_metrics_server(METRICS_PORT))
         loop.create_task(start_spider())
         loop.run_forever()
     finally:
         output_log("Successfully shutdown Spider")
         loop.close()
+        stop_logging()
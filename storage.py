@@ -0,0 +1,15 @@
+import os
+
+# Storage backend for all services: "mongo" or "memory". The memory backend
+# keeps everything in the process, services have to share one process to
+# see each other's data.
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "mongo")
+
+if STORAGE_BACKEND == "mongo":
+    import database as db
+elif STORAGE_BACKEND == "memory":
+    import memory_database as db
+else:
+    raise ValueError(f"Unknown storage backend: {STORAGE_BACKEND}")
+
+__all__ = ["STORAGE_BACKEND", "db"]
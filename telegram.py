@@ -0,0 +1,32 @@
+import json
+from aiogram import Bot
+from aiogram.utils.exceptions import NetworkError
+
+from storage import db
+from proxies import CONNECTION_ERRORS, ProxyPool, load_proxy_urls
+
+SECRETS_FILE = "secrets/credentials.json"
+with open(SECRETS_FILE) as file:
+    secrets = json.load(file)
+
+
+PROXY_URLS = load_proxy_urls(secrets)
+
+API_TOKEN = secrets["api_token"]
+
+
+def create_bot(proxy_url: str) -> Bot:
+    return Bot(token=API_TOKEN, proxy=proxy_url, loop=db.loop)
+
+
+def is_proxy_failure(e: Exception) -> bool:
+    # API errors (flood control, bad requests) came through the proxy,
+    # aiogram wraps aiohttp connection errors into NetworkError
+    return isinstance(e, (NetworkError,) + CONNECTION_ERRORS)
+
+
+# One Bot and HTTP session per proxy and process, the bot and the notifier
+# share them when they run in one process. Notifications are spread over
+# the pool, bot handlers answer through the first proxy.
+bot_pool = ProxyPool("telegram", PROXY_URLS, create_bot, is_proxy_failure)
+bot = bot_pool.primary
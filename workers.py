@@ -0,0 +1,72 @@
+import asyncio
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Hashable, List, Optional
+
+from instrumentation import get_output_log
+
+output_log = get_output_log("workers")
+
+
+class KeyedWorkerPool:
+    # Runs jobs on a fixed number of workers. Jobs with the same key run one
+    # at a time in submission order, different keys run concurrently.
+    # Submitting waits while max_pending jobs are queued or running.
+
+    def __init__(self, handler: Callable[[Any], Awaitable], workers: int, max_pending: int):
+        self.handler = handler
+        self.workers = workers
+        self.max_pending = max_pending
+        self.pending: Dict[Hashable, Deque] = dict()
+        self.ready: Optional[asyncio.Queue] = None
+        self.slots: Optional[asyncio.Semaphore] = None
+        self.tasks: List[asyncio.Task] = list()
+        self.accepting = False
+
+    def start(self):
+        # Queue and semaphore are created on the running loop
+        self.ready = asyncio.Queue()
+        self.slots = asyncio.Semaphore(self.max_pending)
+        self.tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+        self.accepting = True
+
+    async def submit(self, key: Hashable, job: Any):
+        if not self.accepting:
+            raise RuntimeError("Worker pool is not accepting jobs")
+        await self.slots.acquire()
+        jobs = self.pending.get(key)
+        if jobs is None:
+            self.pending[key] = deque([job])
+            self.ready.put_nowait(key)
+        else:
+            jobs.append(job)
+
+    async def _work(self):
+        while True:
+            key = await self.ready.get()
+            jobs = self.pending[key]
+            try:
+                await self.handler(jobs[0])
+            except Exception as e:
+                output_log(f"Job for {key} failed: {e!r}", "ERROR")
+            finally:
+                jobs.popleft()
+                self.slots.release()
+                # Next job of the key goes to the back of the line
+                if jobs:
+                    self.ready.put_nowait(key)
+                else:
+                    del self.pending[key]
+                self.ready.task_done()
+
+    async def drain(self, timeout: float):
+        self.accepting = False
+        if self.ready is not None:
+            try:
+                await asyncio.wait_for(self.ready.join(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pending = sum(len(jobs) for jobs in self.pending.values())
+                output_log(f"Dropping {pending} jobs not done in {timeout} seconds", "WARNING")
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = list()